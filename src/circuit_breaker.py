@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional, Tuple, Type
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """
+    Вызов не выполнялся, потому что предохранитель разомкнут
+    """
+
+
+class CircuitBreaker:
+    """
+    Предохранитель вокруг внешней зависимости (exchange, bot api).
+
+    Пока зависимость отвечает, вызовы проходят как есть (состояние closed).
+    После failure_threshold ошибок подряд предохранитель размыкается (open)
+    и recovery_timeout секунд сразу отвечает CircuitOpenError, не дожидаясь таймаутов.
+    Затем пропускает один пробный вызов (half-open): если он успешен,
+    то предохранитель замыкается, если нет - снова размыкается.
+
+    Смена состояния логируется один раз, а не на каждую ошибку.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 60,
+                 expected_exceptions: Tuple[Type[BaseException], ...] = (Exception,)):
+        """
+        :param name: имя зависимости, для логов
+        :param failure_threshold: сколько ошибок подряд размыкают предохранитель
+        :param recovery_timeout: через сколько секунд после размыкания пробовать снова
+        :param expected_exceptions: какие исключения считать отказом зависимости
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.expected_exceptions = expected_exceptions
+
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._last_error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def call(self, func: Callable, *args, **kwargs):
+        """
+        Вызывает func через предохранитель
+
+        :param func: вызываемая функция
+        :return: результат func
+        :raises CircuitOpenError: если предохранитель разомкнут
+        """
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except self.expected_exceptions as e:
+            self._on_failure(e)
+            raise
+        except BaseException:
+            # неожиданные исключения - не отказ зависимости, просто отпускаем пробный вызов
+            with self._lock:
+                self._probe_in_flight = False
+            raise
+        self._on_success()
+        return result
+
+    def _before_call(self):
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.recovery_timeout:
+                    raise CircuitOpenError(f'{self.name} is unavailable: {self._last_error}')
+                self._state = self.HALF_OPEN
+            # half-open: пропускаем только один пробный вызов за раз
+            if self._probe_in_flight:
+                raise CircuitOpenError(f'{self.name} is being probed')
+            self._probe_in_flight = True
+
+    def _on_success(self):
+        with self._lock:
+            recovered = self._state != self.CLOSED
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+        if recovered:
+            logger.warning(f'{self.name} is available again, circuit closed')
+
+    def _on_failure(self, error: BaseException):
+        with self._lock:
+            self._failures += 1
+            self._last_error = error
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN:
+                # пробный вызов не прошёл - ждём ещё recovery_timeout, без повторного оповещения
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                return
+            if self._state == self.OPEN or self._failures < self.failure_threshold:
+                return
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+        logger.error(f'{self.name} failed {self.failure_threshold} times in a row, circuit opened '
+                     f'for {self.recovery_timeout} s. Last error: {error!r}')
@@ -0,0 +1,94 @@
+import html
+import logging
+from typing import Collection
+
+import vkt
+from incident_index import IncidentIndex
+
+
+logger = logging.getLogger(__name__)
+
+HELP_TEXT = (
+    "<b>Поиск по истории уведомлений</b>\n\n"
+    "/find INC123 - инцидент по номеру\n"
+    "/find слова - поиск по тексту инцидентов и событий мониторинга\n"
+    "/open - открытые инциденты\n"
+    "/server host - события мониторинга по серверу"
+)
+
+# сколько результатов показывать в ответе на команду
+RESULTS_LIMIT = 10
+
+
+def render_result(item: dict) -> str:
+    """
+    Формирует короткое описание найденного уведомления для ответа на команду
+
+    :param item: поля DTO из индекса (см. IncidentIndex)
+    :return: HTML-текст
+    """
+    fields = {key: html.escape(str(value)) for key, value in item.items()}
+    if item['kind'] == 'incident':
+        subject = fields['subject'] if len(item['subject']) <= 200 else html.escape(item['subject'][:200]) + '…'
+        return (
+            f"<b>#{fields['idx']}   #{fields['status']}</b> ⭐ {fields['priority']}\n"
+            f"🏭 {fields['org_unit']}\n"
+            f"🪧 {subject}\n"
+            f"🔗 <a href=\"{fields['link']}\">Инцидент в ITSM</a>"
+        )
+    return (
+        f"{fields['priority_emoji']} <b>{fields['server']}</b> <i>{fields['registration_date']}</i>\n"
+        f"📖 {fields['description']}"
+    )
+
+
+def run_command(index: IncidentIndex, text: str) -> str:
+    """
+    Выполняет команду поиска и формирует текст ответа
+
+    :param index: индекс уведомлений
+    :param text: текст сообщения с командой, например '/find INC123'
+    :return: HTML-текст ответа
+    """
+    command, _, argument = text.strip().partition(' ')
+    # в группах команда может прийти с упоминанием бота: /find@bot_nick
+    command = command.split('@')[0].lower()
+
+    if command == '/find' and argument.strip():
+        results = index.find(argument, RESULTS_LIMIT)
+    elif command == '/open':
+        results = index.open_incidents(RESULTS_LIMIT)
+    elif command == '/server' and argument.strip():
+        results = index.by_server(argument, RESULTS_LIMIT)
+    else:
+        return HELP_TEXT
+
+    if not results:
+        return 'Ничего не найдено'
+    return '\n\n'.join(render_result(item) for item in results)
+
+
+def handle_commands(bot: vkt.Bot, events: list[dict], index: IncidentIndex, chats: Collection[str]) -> int:
+    """
+    Отвечает на команды поиска, присланные боту.
+    В индексе вся история инцидентов с именами заявителей, поэтому отвечает только в разрешённых чатах
+
+    :param bot: объект VK Teams бота
+    :param events: события newMessage
+    :param index: индекс уведомлений
+    :param chats: id чатов, в которых можно отвечать на команды
+    :return: количество обработанных команд
+    """
+    handled = 0
+    for event in events:
+        text = event['payload'].get('text', '')
+        if not text.startswith('/'):
+            continue
+        chat_id = event['payload']['chat']['chatId']
+        if chat_id not in chats:
+            logger.warning(f'Command "{text}" from {chat_id} is ignored: the chat is not allowed')
+            continue
+        logger.info(f'Command "{text}" from {chat_id}')
+        bot.send_message(text=run_command(index, text), chat_id=chat_id)
+        handled += 1
+    return handled
@@ -0,0 +1,229 @@
+import logging
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import closing
+from typing import Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class Store(ABC):
+    """
+    Общее для всех реплик хранилище: аренды (lease) с временем жизни и простые ключ-значение.
+    Напрямую не используется, используются дочерние классы - конкретные реализации.
+
+    Интерфейс нарочно повторяет примитивы Redis, чтобы хранилище можно было заменить:
+    acquire - SET key owner NX PX ttl (или продление своей аренды), release - удаление своей аренды,
+    get/set - GET/SET, owners - SCAN по префиксу
+    """
+
+    @abstractmethod
+    def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        """
+        Берёт аренду key на ttl секунд, если она свободна, просрочена или уже принадлежит owner
+
+        :return: True - аренда принадлежит owner
+        """
+        pass
+
+    @abstractmethod
+    def release(self, key: str, owner: str):
+        """
+        Отпускает аренду key, если она принадлежит owner
+        """
+        pass
+
+    @abstractmethod
+    def owners(self, prefix: str) -> Dict[str, str]:
+        """
+        :return: действующие аренды, ключи которых начинаются с prefix, в виде {ключ: владелец}
+        """
+        pass
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: str):
+        pass
+
+
+class MemoryStore(Store):
+    """
+    Хранилище в памяти процесса. Подходит, когда реплика одна
+    """
+
+    def __init__(self):
+        self._leases: Dict[str, Tuple[str, float]] = {}
+        self._values: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            current_owner, expires_at = self._leases.get(key, (owner, 0))
+            if current_owner != owner and expires_at >= now:
+                return False
+            self._leases[key] = (owner, now + ttl)
+            return True
+
+    def release(self, key: str, owner: str):
+        with self._lock:
+            if self._leases.get(key, ('', 0))[0] == owner:
+                del self._leases[key]
+
+    def owners(self, prefix: str) -> Dict[str, str]:
+        now = time.time()
+        with self._lock:
+            return {
+                key: owner for key, (owner, expires_at) in self._leases.items()
+                if key.startswith(prefix) and expires_at >= now
+            }
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._values.get(key)
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._values[key] = value
+
+
+class SQLiteStore(Store):
+    """
+    Хранилище в SQLite-файле, общем для всех реплик (например, на общем docker volume)
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: путь к файлу базы
+        """
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS leases '
+                '(key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)')
+
+    def _connect(self) -> sqlite3.Connection:
+        # соединение на каждую операцию: задачи планировщика выполняются в разных потоках
+        return sqlite3.connect(self.path, timeout=10)
+
+    def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            # одна upsert-операция атомарна, поэтому двум репликам одну аренду не выдать
+            conn.execute(
+                'INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE leases.owner = excluded.owner OR leases.expires_at < ?',
+                (key, owner, now + ttl, now)
+            )
+            row = conn.execute('SELECT owner FROM leases WHERE key = ?', (key, )).fetchone()
+        return row is not None and row[0] == owner
+
+    def release(self, key: str, owner: str):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, owner))
+
+    def owners(self, prefix: str) -> Dict[str, str]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                'SELECT key, owner FROM leases WHERE substr(key, 1, ?) = ? AND expires_at >= ?',
+                (len(prefix), prefix, time.time())
+            ).fetchall()
+        return dict(rows)
+
+    def get(self, key: str) -> Optional[str]:
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT value FROM kv WHERE key = ?', (key, )).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                (key, value)
+            )
+
+
+class Coordinator:
+    """
+    Координация нескольких реплик бота поверх общего хранилища:
+    выбор лидера для задач, которые должна выполнять только одна реплика (обработка коллбэков),
+    и раздел между репликами партиций (папок с письмами), чтобы письма не обрабатывались дважды.
+
+    Всё построено на арендах: реплика владеет ролью или партицией, пока продлевает аренду.
+    Если реплика умирает, то её аренды истекают через ttl и их забирают остальные
+    """
+
+    def __init__(self, store: Store, replica_id: str = '', ttl: float = 30):
+        """
+        :param store: общее хранилище
+        :param replica_id: уникальный id реплики. По умолчанию hostname-pid
+        :param ttl: время жизни аренды в секундах.
+                    Должно быть больше интервала задачи, которая эту аренду продлевает
+        """
+        self.store = store
+        self.replica_id = replica_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.ttl = ttl
+        self._roles = set()
+
+    def is_leader(self, role: str, ttl: float = None) -> bool:
+        """
+        Берёт или продлевает лидерство в роли
+
+        :param role: название роли, например 'callbacks'
+        :param ttl: время жизни аренды, по умолчанию self.ttl
+        :return: True - эта реплика лидер
+        """
+        leader = self.store.acquire(f'leader:{role}', self.replica_id, ttl or self.ttl)
+        if leader and role not in self._roles:
+            logger.info(f'Replica {self.replica_id} became the leader of {role}')
+            self._roles.add(role)
+        elif not leader and role in self._roles:
+            logger.warning(f'Replica {self.replica_id} lost the leadership of {role}')
+            self._roles.discard(role)
+        return leader
+
+    def owned_partitions(self, partitions: List[str], ttl: float = None) -> List[str]:
+        """
+        Отмечает реплику живой и забирает ей честную долю партиций:
+        ceil(партиций / живых реплик). Лишние партиции отпускает, чтобы их забрали другие
+
+        :param partitions: все партиции, например типы обработчиков писем
+        :param ttl: время жизни аренды, по умолчанию self.ttl
+        :return: партиции, которыми владеет эта реплика
+        """
+        ttl = ttl or self.ttl
+        self.store.acquire(f'member:{self.replica_id}', self.replica_id, ttl)
+        members = sorted(self.store.owners('member:').values())
+        share = math.ceil(len(partitions) / max(len(members), 1))
+
+        # каждая реплика начинает со своего места в списке, чтобы не толкаться за первые партиции
+        offset = members.index(self.replica_id) if self.replica_id in members else 0
+        ordered = partitions[offset:] + partitions[:offset]
+
+        owned = []
+        for partition in ordered:
+            key = f'partition:{partition}'
+            if len(owned) < share and self.store.acquire(key, self.replica_id, ttl):
+                owned.append(partition)
+            else:
+                self.store.release(key, self.replica_id)
+        return owned
+
+    def load(self, key: str) -> Optional[str]:
+        return self.store.get(key)
+
+    def save(self, key: str, value: str):
+        self.store.set(key, value)
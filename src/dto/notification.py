@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Union
 
 
@@ -10,6 +10,10 @@ class Notification(ABC):
     Напрямую не используется, используются дочерние классы - конкретные реализации
     """
 
+    # ключ трассы (см. tracing): id письма в exchange, из которого собран DTO.
+    # В сравнении и repr не участвует - это служебное поле, а не данные уведомления
+    trace_id: str = field(default='', compare=False, repr=False)
+
     @classmethod
     @abstractmethod
     def from_notification(cls, notification_text: str) -> Union['Notification', None]:
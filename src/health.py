@@ -0,0 +1,60 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from outbound import PriorityOutbox
+from safe_scheduler import SafeScheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+def serve_health(scheduler: SafeScheduler, port: int, host: str = '0.0.0.0',
+                 outbox: PriorityOutbox = None) -> ThreadingHTTPServer:
+    """
+    Поднимает в фоновом потоке http-сервер с эндпоинтом /health.
+    Эндпоинт отдаёт json с возрастом последнего успешного запуска каждой задачи планировщика
+    и статистикой планировщика. Если хоть одна задача давно не отрабатывала успешно,
+    то отвечает кодом 503, иначе 200
+
+    :param scheduler: планировщик, задачи которого проверяем
+    :param port: порт сервера
+    :param host: адрес, на котором слушает сервер
+    :param outbox: очередь исходящих уведомлений, её метрики тоже попадут в ответ (опционально)
+    :return: запущенный сервер
+    """
+
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/health':
+                self.send_error(404)
+                return
+
+            jobs = scheduler.health()
+            metrics = scheduler.metrics()
+            for name, job in jobs.items():
+                job['metrics'] = metrics.get(name, {})
+            healthy = not any(job['stale'] for job in jobs.values())
+
+            status = {'status': 'ok' if healthy else 'stale', 'jobs': jobs}
+            if outbox is not None:
+                status['outbound'] = outbox.metrics()
+            body = json.dumps(
+                status,
+                default=str, ensure_ascii=False
+            ).encode()
+            self.send_response(200 if healthy else 503)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # запросы healthcheck'а не логируем, иначе они улетят в чат с логами
+            pass
+
+    server = ThreadingHTTPServer((host, port), HealthHandler)
+    threading.Thread(target=server.serve_forever, name='health', daemon=True).start()
+    logger.info(f'Health endpoint is listening on {host}:{port}/health')
+    return server
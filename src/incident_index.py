@@ -0,0 +1,178 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from typing import List
+
+from dto import Notification, Incident, Monitoring
+
+
+logger = logging.getLogger(__name__)
+
+
+class IncidentIndex:
+    """
+    Локальный поисковый индекс инцидентов и событий мониторинга на SQLite.
+    Поля idx, status, org_unit и server проиндексированы,
+    полнотекстовый поиск по остальному тексту - через FTS5.
+    Если SQLite собран без FTS5, то полнотекстовый поиск деградирует до LIKE
+    """
+
+    def __init__(self, path: str = ':memory:'):
+        """
+        :param path: путь к файлу базы. По умолчанию индекс живёт только в памяти
+        """
+        self.path = path
+        # соединение одно на всех, к нему обращаются задачи из разных потоков - защищаем блокировкой
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            # индекс можно восстановить, поэтому не ждём fsync на каждую запись
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS notifications ('
+                'id INTEGER PRIMARY KEY, kind TEXT NOT NULL, idx TEXT COLLATE NOCASE, status TEXT COLLATE NOCASE, '
+                'priority TEXT, org_unit TEXT COLLATE NOCASE, server TEXT COLLATE NOCASE, '
+                'indexed_at REAL NOT NULL, data TEXT NOT NULL)'
+            )
+            for column in ('idx', 'status', 'org_unit', 'server'):
+                self._conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS notifications_{column} '
+                    f'ON notifications ({column}, indexed_at)'
+                )
+            try:
+                self._conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS notifications_fts USING fts5(text)')
+                self.fts = True
+            except sqlite3.OperationalError:
+                logger.warning('SQLite is built without FTS5, full-text search falls back to LIKE')
+                self.fts = False
+
+    def add(self, notification: Notification):
+        """
+        Добавляет уведомление в индекс. Инцидент с уже известным номером обновляется.
+        Новое письмо по нему (например, повторное назначение на группу) уходит в чат новым сообщением
+        со статусом из письма, поэтому и статус берётся из DTO. Если же повторно индексируется то же письмо,
+        то статус, выставленный в чате (см. set_status), сохраняется
+
+        :param notification: DTO инцидента или мониторинга
+        """
+        data = asdict(notification)
+        if isinstance(notification, Incident):
+            row = dict(kind='incident', idx=notification.idx, status=notification.status,
+                       priority=notification.priority, org_unit=notification.org_unit, server=None)
+            text = ' '.join([notification.idx, notification.family_name, notification.name,
+                             notification.org_unit, notification.subject, notification.description])
+        elif isinstance(notification, Monitoring):
+            row = dict(kind='monitoring', idx=None, status=None,
+                       priority=notification.priority, org_unit=None, server=notification.server)
+            text = ' '.join([notification.server, notification.description])
+        else:
+            return
+
+        with self._lock, self._conn:
+            existing = None
+            if row['idx']:
+                existing = self._conn.execute(
+                    'SELECT id, status, data FROM notifications WHERE idx = ? AND kind = ?', (row['idx'], row['kind'])
+                ).fetchone()
+            if existing:
+                rowid, status, stored = existing
+                # письмо узнаём по ключу трассы - id письма в exchange
+                if data['trace_id'] and json.loads(stored).get('trace_id') == data['trace_id']:
+                    data['status'] = status
+                self._conn.execute(
+                    'UPDATE notifications SET status = ?, priority = ?, org_unit = ?, indexed_at = ?, data = ? '
+                    'WHERE id = ?',
+                    (data['status'], row['priority'], row['org_unit'], time.time(), json.dumps(data), rowid)
+                )
+            else:
+                rowid = self._conn.execute(
+                    'INSERT INTO notifications (kind, idx, status, priority, org_unit, server, indexed_at, data) '
+                    'VALUES (:kind, :idx, :status, :priority, :org_unit, :server, :indexed_at, :data)',
+                    dict(row, indexed_at=time.time(), data=json.dumps(data))
+                ).lastrowid
+            if self.fts:
+                self._conn.execute('DELETE FROM notifications_fts WHERE rowid = ?', (rowid, ))
+                self._conn.execute('INSERT INTO notifications_fts (rowid, text) VALUES (?, ?)', (rowid, text))
+
+    def set_status(self, idx: str, status: str):
+        """
+        Меняет статус инцидента (например, после нажатия кнопки в VK Teams)
+
+        :param idx: номер инцидента
+        :param status: новый статус
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT id, data FROM notifications WHERE idx = ? AND kind = 'incident'", (idx, )
+            ).fetchone()
+            if not row:
+                return
+            data = dict(json.loads(row[1]), status=status)
+            self._conn.execute(
+                'UPDATE notifications SET status = ?, data = ? WHERE id = ?', (status, json.dumps(data), row[0])
+            )
+
+    def known(self, idx: str) -> bool:
+        """
+        :param idx: номер инцидента
+        :return: есть ли инцидент в индексе
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM notifications WHERE idx = ? AND kind = 'incident' LIMIT 1", (idx, )
+            ).fetchone() is not None
+
+    def _select(self, where: str, params: tuple, limit: int) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT kind, data FROM notifications WHERE {where} ORDER BY indexed_at DESC LIMIT ?',
+                params + (limit, )
+            ).fetchall()
+        return [dict(json.loads(data), kind=kind) for kind, data in rows]
+
+    def find(self, query: str, limit: int = 10) -> List[dict]:
+        """
+        Ищет уведомления: по номеру инцидента, если запрос на него похож, иначе полнотекстово
+
+        :param query: номер инцидента (INC123) или слова для поиска
+        :param limit: максимальное количество результатов
+        :return: список полей найденных DTO (+ поле kind: 'incident' или 'monitoring'), свежие первыми
+        """
+        query = query.strip()
+        if re.fullmatch(r'INC\d+', query, re.IGNORECASE):
+            return self._select('idx = ?', (query, ), limit)
+
+        words = re.findall(r'\w+', query)
+        if not words:
+            return []
+        if self.fts:
+            # каждое слово ищем по префиксу, спецсимволы FTS-запроса из пользовательского ввода не пропускаем
+            # FTS5 отдаёт совпадения в порядке rowid, поэтому свежие берём с конца и останавливаемся на limit
+            match = ' '.join(f'"{word}"*' for word in words)
+            return self._select(
+                'id IN (SELECT rowid FROM notifications_fts WHERE text MATCH ? ORDER BY rowid DESC LIMIT ?)',
+                (match, limit), limit
+            )
+        return self._select(
+            ' AND '.join(['data LIKE ?'] * len(words)), tuple(f'%{word}%' for word in words), limit
+        )
+
+    def open_incidents(self, limit: int = 10) -> List[dict]:
+        """
+        :param limit: максимальное количество результатов
+        :return: открытые инциденты, свежие первыми
+        """
+        return self._select("status = 'OPEN' AND kind = 'incident'", (), limit)
+
+    def by_server(self, server: str, limit: int = 10) -> List[dict]:
+        """
+        :param server: имя сервера целиком или его начало (например, без домена)
+        :param limit: максимальное количество результатов
+        :return: события мониторинга по серверу, свежие первыми
+        """
+        return self._select('server LIKE ?', (server.strip() + '%', ), limit)
@@ -1,11 +1,15 @@
 import logging
+import time
 from abc import abstractmethod, ABC
-from typing import TYPE_CHECKING, Generator
+from typing import TYPE_CHECKING, Callable, Generator, Union
 
 if TYPE_CHECKING:
     import exchangelib
 
+from circuit_breaker import CircuitBreaker
 from dto import Notification, Monitoring, Incident
+from incident_index import IncidentIndex
+import tracing
 
 
 logger = logging.getLogger(__name__)
@@ -20,24 +24,53 @@ class MailHandler(ABC):
     type: str
     Dto: Notification
 
-    def __init__(self, mail_dir: 'exchangelib.folders.known_folders.Messages'):
+    def __init__(self,
+                 mail_dir: Union['exchangelib.folders.known_folders.Messages',
+                                 Callable[[], 'exchangelib.folders.known_folders.Messages']],
+                 breaker: CircuitBreaker = None,
+                 index: IncidentIndex = None):
         """
         Принимает exchange папку с письмами, с которой в дальнейшем и будет работать.
 
-        :param mail_dir: exchange папка с письмами
+        :param mail_dir: exchange папка с письмами или функция, которая её возвращает.
+                         Функция вызывается при первом обращении к папке - так подключение
+                         к exchange можно отложить до первой проверки почты
+        :param breaker: предохранитель для запросов к exchange.
+                        Можно передать один и тот же нескольким обработчикам одного сервера
+        :param index: индекс, в который складываются все сформированные DTO (опционально)
         """
-        self.mail_dir = mail_dir
+        self._mail_dir = mail_dir
+        self.breaker = breaker or CircuitBreaker('Exchange')
+        self.index = index
 
+    @property
+    def mail_dir(self) -> 'exchangelib.folders.known_folders.Messages':
+        if callable(self._mail_dir):
+            self._mail_dir = self._mail_dir()
+        return self._mail_dir
+
+    @classmethod
     @abstractmethod
+    def matches(cls, sender: str, subject: str) -> bool:
+        """
+        Метод, который проверяет по отправителю и теме, соответствует ли письмо фильтру.
+        То есть является ли тем, что мы ищем.
+        Принимает строки, а не exchange-письмо, чтобы те же правила применялись к выгруженным .eml (см. replay.py)
+
+        :param sender: email отправителя
+        :param subject: тема письма
+        :return: True - письмо соответствует фильтру, False - не соответствует
+        """
+        pass
+
     def is_notification(self, item: 'exchangelib.items.message.Message') -> bool:
         """
-        Метод, который проверяет, соответствует ли переданное письмо фильтру.
-        То есть является ли тем, что мы ищем
+        Проверяет, соответствует ли переданное письмо фильтру (см. matches)
 
         :param item: exchange-письмо
         :return: True - письмо соответствует фильтру, False - не соответствует
         """
-        pass
+        return self.matches(item.sender.email_address, item.subject)
 
     def new_messages(self) -> Generator[Notification, None, None]:
         """
@@ -49,7 +82,9 @@ class MailHandler(ABC):
         """
 
         # вычитываем из папки непрочитанные письма
-        unread_emails = list(self.mail_dir.filter(is_read=False))
+        fetch_started = time.time()
+        unread_emails = self.breaker.call(lambda: list(self.mail_dir.filter(is_read=False)))
+        fetch_finished = time.time()
         if not unread_emails:
             logger.info(f'No new {self.type} emails')
             return
@@ -64,19 +99,36 @@ class MailHandler(ABC):
                 # item.is_read = True  # Помечаем письмо как прочитанное
                 continue
 
-            # из текста письма формируем DTO
-            dto_obj = self.Dto.from_notification(item.text_body)
-
-            # если не получилось - ругаемся пропускаем
-            if not dto_obj:
-                logger.error(f'Incorrect {self.type} message format')
-                item.is_read = True  # Помечаем письмо как прочитанное
-                item.save()
-                continue
-
-            logger.info(dto_obj)
-            item.is_read = True  # Помечаем письмо как прочитанное
-            item.save()
+            with tracing.trace(item.id or ''):
+                # сколько письмо пролежало в ящике до вычитки и сколько заняла сама вычитка (на всю пачку)
+                if item.datetime_received:
+                    tracing.record('mail.received', item.datetime_received.timestamp(), fetch_started,
+                                   handler=self.type)
+                tracing.record('mail.fetch', fetch_started, fetch_finished, handler=self.type,
+                               batch=len(unread_emails))
+
+                # из текста письма формируем DTO
+                with tracing.span('dto.parse', handler=self.type) as attrs:
+                    dto_obj = self.Dto.from_notification(item.text_body)
+                    attrs['parsed'] = bool(dto_obj)
+                    if isinstance(dto_obj, Incident):
+                        # по номеру инцидента трассу письма можно связать с редактированиями сообщения
+                        attrs['inc'] = dto_obj.idx
+
+                # если не получилось - ругаемся пропускаем
+                if not dto_obj:
+                    logger.error(f'Incorrect {self.type} message format')
+                    item.is_read = True  # Помечаем письмо как прочитанное
+                    self.breaker.call(item.save)
+                    continue
+
+                logger.info(dto_obj)
+                dto_obj.trace_id = item.id or ''
+                with tracing.span('mail.mark_read', handler=self.type):
+                    item.is_read = True  # Помечаем письмо как прочитанное
+                    self.breaker.call(item.save)
+                if self.index:
+                    self.index.add(dto_obj)
             yield dto_obj
 
 
@@ -88,15 +140,17 @@ class MonitoringHandler(MailHandler):
     type = 'monitoring'  # тип письма, чисто для логов
     Dto = Monitoring  # класс DTO, в который будет преобразовываться письмо
 
-    def is_notification(self, item) -> bool:
-        return item.sender.email_address == 'no-reply.monitoring@lukoil.com' \
-               and '.srv.lukoil.com' in item.subject
+    @classmethod
+    def matches(cls, sender: str, subject: str) -> bool:
+        return sender == 'no-reply.monitoring@lukoil.com' \
+               and '.srv.lukoil.com' in subject
 
 
 class IncidentHandler(MailHandler):
     type = 'incident'
     Dto = Incident
 
-    def is_notification(self, item):
-        return item.sender.email_address == 'prd.support@lukoil.com' \
-               and '] назначено на вашу группу [' in item.subject
+    @classmethod
+    def matches(cls, sender: str, subject: str) -> bool:
+        return sender == 'prd.support@lukoil.com' \
+               and '] назначено на вашу группу [' in subject
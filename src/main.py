@@ -1,38 +1,51 @@
-import os
-import logging
 import time
-from typing import TYPE_CHECKING
 
-from dotenv import load_dotenv
-from exchangelib import Credentials, Account, DELEGATE, Configuration
-from exchangelib.errors import ErrorFolderNotFound
+# момент старта процесса (почти): от него считаем, сколько занял импорт модулей
+STARTED = time.perf_counter()
+
+import datetime as dt
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Callable, Union
 
 import mail_handler
 
 if TYPE_CHECKING:
     import exchangelib
 
-from dto import Incident
+from dto import Notification, Incident
 from mail_handler import MonitoringHandler, IncidentHandler
 import vkt
 import vkt_logger
+import tracing
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from commands import handle_commands
+from coordination import Coordinator, MemoryStore, SQLiteStore
+from health import serve_health
+from incident_index import IncidentIndex
+from outbound import PriorityOutbox
 from safe_scheduler import SafeScheduler
+from settings import Settings
 
-load_dotenv()
+IMPORTED = time.perf_counter()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s\t%(name)s\t%(levelname)s\t%(message)s"
-)
-
-vkt_logger.setup(
-    logging.getLogger(),
-    api_url=os.environ['VKT_BASE_URL'],
-    token=os.environ['VKT_BOT_TOKEN'],
-    chats=[os.environ['VKT_ADMIN_ID'], ]
-)
 logger = logging.getLogger('bot')
 
+# время жизни аренд координатора: с запасом больше deadline задач, которые эти аренды продлевают
+PARTITION_TTL = 180
+LEADER_TTL = 60
+
+# максимальная длительность обработки событий. Меньше LEADER_TTL: пока лидер обрабатывает пачку событий,
+# его аренда не должна истечь, иначе другая реплика станет лидером и обработает те же события
+EVENTS_DEADLINE = 30
+
+# сколько запросов к bot api одновременно выполнять при обработке пачки коллбэков
+CALLBACK_WORKERS = 8
+
+# сколько секунд подряд отправлять уведомления из очереди, остальное - в следующий запуск задачи
+SEND_BUDGET = 30
+
 
 def walk_mail(
         mail_dir: 'exchangelib.folders.known_folders.Messages', path: str = ''
@@ -55,37 +68,125 @@ def walk_mail(
     return result_folder
 
 
+class Exchange:
+    """
+    Ленивое подключение к exchange.
+    exchangelib (а с ним lxml, requests-ntlm, tzlocal и прочее) импортируется,
+    а autodiscover выполняется только при первом обращении к папкам, то есть в первой проверке почты.
+    Благодаря этому бот запускается и начинает обрабатывать кнопки и команды, не дожидаясь exchange
+    """
+
+    def __init__(self, settings: Settings):
+        """
+        :param settings: настройки бота
+        """
+        self.settings = settings
+        self._account = None
+        self._lock = threading.Lock()
+
+    @property
+    def account(self) -> 'exchangelib.Account':
+        with self._lock:
+            if self._account is None:
+                self._account = self._connect()
+            return self._account
+
+    def _connect(self) -> 'exchangelib.Account':
+        started = time.perf_counter()
+        from exchangelib import Credentials, Account, DELEGATE, Configuration
+        from exchangelib.protocol import BaseProtocol
+        imported = time.perf_counter()
+
+        # таймаут запросов к exchange, чтобы зависшее соединение не подвешивало обработчик
+        BaseProtocol.TIMEOUT = self.settings.exc_timeout
+
+        creds = Credentials(username=self.settings.exc_user, password=self.settings.exc_password)
+        if self.settings.exc_autodiscover:
+            config = Configuration(
+                server=self.settings.exc_server,
+                # retry_policy=FaultTolerance(max_wait=3600),
+                credentials=creds
+            )
+        else:
+            # без autodiscover EXC_SERVER - это адрес EWS целиком, .../EWS/Exchange.asmx
+            config = Configuration(service_endpoint=self.settings.exc_server, credentials=creds)
+        account = Account(
+            primary_smtp_address=self.settings.exc_email,
+            config=config,
+            autodiscover=self.settings.exc_autodiscover,
+            access_type=DELEGATE
+        )
+        logger.info(f'Connected to Exchange in {time.perf_counter() - started:.2f} s '
+                    f'(exchangelib import {imported - started:.2f} s)')
+        return account
+
+    def folder(self, path: str) -> Callable[[], 'exchangelib.folders.known_folders.Messages']:
+        """
+        :param path: путь относительно папки "Входящие" (см. walk_mail)
+        :return: функция, возвращающая exchange-папку; подключение к exchange - при её вызове
+        """
+        return lambda: walk_mail(self.account.inbox, path)
+
+
+def send_notification(bot: vkt.Bot, message: Notification, settings: Settings,
+                      postpone: bool = True) -> Union[str, None]:
+    """
+    Формирует сообщение по DTO уведомления и отправляет его в VK Teams:
+    инциденты - в чат VKT_CHAT_ID, события мониторинга - в чат VKT_MONITORING_CHAT_ID
+
+    :param bot: объект VK Teams бота
+    :param message: DTO инцидента или мониторинга
+    :param settings: настройки бота
+    :param postpone: откладывать ли сообщение в bot.outbox, если bot api недоступен (см. vkt.Bot.send_message)
+    :return: id отправленного сообщения, None если сообщение отложено
+    """
+    with tracing.trace(message.trace_id):
+        if isinstance(message, Incident):
+            message.editor = bot.nickname
+            kind, chat_id = 'incident', settings.vkt_chat_id
+        else:
+            kind, chat_id = 'monitoring', settings.vkt_monitoring_chat_id
+        with tracing.span('dto.render', handler=kind):
+            vkt_message = message.prep_vkt_message()
+        return bot.send_message(
+            text=vkt_message['text'],
+            chat_id=chat_id,
+            inline_kb=vkt_message.get('inlineKB', ''),
+            postpone=postpone
+        )
+
+
 def handle_notifications(
-        bot: vkt.Bot, inc_handler: mail_handler.IncidentHandler, mon_handler: mail_handler.MonitoringHandler
+        outbox: PriorityOutbox, inc_handler: mail_handler.IncidentHandler,
+        mon_handler: mail_handler.MonitoringHandler, coordinator: Coordinator
         ):
     """
-    Собирает DTO уведомлений из обработчиков писем,
-    рассылает соответствующие сообщения в VK Teams
+    Собирает DTO уведомлений из обработчиков писем и ставит их в очередь на отправку в VK Teams.
+    Отправляет их send_notifications - в порядке приоритета, а не в порядке писем.
+    Если реплик бота несколько, то обрабатывает только доставшиеся этой реплике обработчики
 
-    :param bot: объект VK Teams бота
+    :param outbox: очередь исходящих уведомлений
     :param inc_handler: обработчик писем инцидентов
     :param mon_handler: обработчик писем мониторинга
+    :param coordinator: координатор реплик
+    :return: количество новых уведомлений (для планировщика: была ли работа)
     """
+    from exchangelib.errors import ErrorFolderNotFound
+
+    queued = 0
     try:
         logger.info('Checking new emails...')
+        owned = coordinator.owned_partitions([inc_handler.type, mon_handler.type], ttl=PARTITION_TTL)
+
         # проходимся по письмам-инцидентам
-        for message in inc_handler.new_messages():
-            message.editor = bot.nickname
-            vkt_message = message.prep_vkt_message()
-            bot.send_message(
-                text=vkt_message['text'],
-                chat_id=os.environ['VKT_CHAT_ID'],
-                inline_kb=vkt_message.get('inlineKB', '')
-            )
+        for message in (inc_handler.new_messages() if inc_handler.type in owned else []):
+            outbox.put(message)
+            queued += 1
 
         # проходимся по письмам мониторинга
-        for message in mon_handler.new_messages():
-            vkt_message = message.prep_vkt_message()
-            bot.send_message(
-                text=vkt_message['text'],
-                chat_id=os.environ['VKT_MONITORING_CHAT_ID'],
-                inline_kb=vkt_message.get('inlineKB', '')
-            )
+        for message in (mon_handler.new_messages() if mon_handler.type in owned else []):
+            outbox.put(message)
+            queued += 1
 
         logger.info('Waiting for next email check...')
     except ErrorFolderNotFound as e:
@@ -96,102 +197,270 @@ def handle_notifications(
         print('Прервано пользователем')
         logger.info('Прервано пользователем')
         return
-    except Exception as e:
-        print(f'Ошибка: {e}')
-        logger.exception(e)
+    # прочие ошибки не глушим: их залогирует планировщик
+    # и отложит следующую проверку (см. SafeScheduler)
+    return queued
 
 
-def handle_callbacks(bot: vkt.Bot):
+def send_notifications(bot: vkt.Bot, outbox: PriorityOutbox, settings: Settings) -> int:
     """
-    Обрабатывает коллбэки - нажатия на кнопки "пометить закрытым" и "пометить открытым"
+    Отправляет уведомления из очереди, начиная с самых срочных (см. PriorityOutbox).
+    Пока bot api недоступен, уведомления ждут в очереди (и в OUTBOX_DB), сохраняя приоритеты,
+    а не уходят в bot.outbox, который живёт только в памяти
 
     :param bot: объект VK Teams бота
+    :param outbox: очередь исходящих уведомлений
+    :param settings: настройки бота
+    :return: количество отправленных уведомлений
+    """
+    return outbox.drain(
+        lambda message: send_notification(bot, message, settings, postpone=False),
+        budget=SEND_BUDGET,
+        paused=lambda: bot.breaker.is_open,
+        retry=vkt.API_ERRORS
+    )
+
+
+def incident_link(message: dict) -> str:
+    """
+    Ищет в прикреплённой к сообщению клавиатуре кнопку "Инцидент в ITSM"
+    и возвращает ссылку на инцидент из этой кнопки
+
+    :param message: сообщение из события bot api
+    :return: ссылка на инцидент или пустая строка, если кнопки нет
+    """
+    for part in message['parts']:
+        if part['type'] != 'inlineKeyboardMarkup':
+            continue
+        buttons = [btn for row in part['payload'] for btn in row]
+        for button in buttons:
+            if 'Инцидент в ITSM' in button['text']:
+                return button["url"]
+    return ''
+
+
+def coalesce_callbacks(events: list[dict]) -> dict[str, dict]:
+    """
+    Группирует события нажатий кнопок по сообщениям.
+    Из нескольких нажатий на одном сообщении важно только последнее:
+    оно и определяет итоговый статус инцидента
+
+    :param events: события callbackQuery в порядке их поступления
+    :return: словарь {id сообщения: последнее событие нажатия на нём}
     """
-    # вычитываем события нажатий на callback-кнопки (см. bot api)
-    events = bot.get_events(['callbackQuery', ])
+    last_events = {}
     for event in events:
-        # получаем текст сообщения, на котором нажата кнопка
-        message = event['payload']['message']
-
-        # ищем в прикреплённой к сообщению клавиатуре кнопку "Инцидент в ITSM".
-        # Если такая есть, то дёргаем ссылку на инцидент из этой кнопки
-        link = ''
-        for part in message['parts']:
-            if part['type'] != 'inlineKeyboardMarkup':
-                continue
-            buttons = [btn for row in part['payload'] for btn in row]
-            for button in buttons:
-                if 'Инцидент в ITSM' not in button['text']:
-                    continue
-                link = button["url"]
-                break
-            if link:
-                break
-
-        # получаем DTO инцидента из текста сообщения и ссылки на инцидент,
-        # отмечаем как редактора пользователя, нажавшего кнопку,
-        # изменяем статус инцидента на соответствующий нажатой кнопке
-        inc = Incident.from_vkt_message(message['text'], link)
-        inc.editor = event['payload']['from']['userId']
-        if event['payload']['callbackData'] == 'close':
-            inc.status = 'CLOSED'
-        if event['payload']['callbackData'] == 'open':
-            inc.status = 'OPEN'
-
-        # подменяем сообщение, на котором нажата кнопка, но вновь сформированное
-        message_id = message['msgId']
-        vkt_message = inc.prep_vkt_message()
+        last_events[event['payload']['message']['msgId']] = event
+    return last_events
+
+
+def apply_callback(bot: vkt.Bot, event: dict, index: IncidentIndex, settings: Settings):
+    """
+    Меняет статус инцидента в сообщении в соответствии с нажатой кнопкой
+
+    :param bot: объект VK Teams бота
+    :param event: событие callbackQuery
+    :param index: индекс уведомлений, в котором тоже нужно обновить статус
+    :param settings: настройки бота
+    """
+    # получаем текст сообщения, на котором нажата кнопка
+    message = event['payload']['message']
+
+    # получаем DTO инцидента из текста сообщения и ссылки на инцидент
+    inc = Incident.from_vkt_message(message['text'], incident_link(message))
+    if not inc:
+        return
+
+    # изменяем статус инцидента на соответствующий нажатой кнопке.
+    # Если статус и так такой (например, закрыли и тут же открыли обратно), то сообщение не трогаем
+    status = {'close': 'CLOSED', 'open': 'OPEN'}.get(event['payload']['callbackData'], inc.status)
+    if status == inc.status:
+        return
+
+    # отмечаем как редактора пользователя, нажавшего кнопку,
+    # и подменяем сообщение, на котором нажата кнопка, вновь сформированным
+    inc.status = status
+    inc.editor = event['payload']['from']['userId']
+    # у редактирований нет письма, ключ трассы - номер инцидента
+    with tracing.trace(inc.idx):
+        with tracing.span('dto.render', handler='callback'):
+            vkt_message = inc.prep_vkt_message()
         bot.edit_message(
-            msg_id=message_id,
+            msg_id=message['msgId'],
             text=vkt_message['text'],
-            chat_id=os.environ['VKT_CHAT_ID'],
+            chat_id=settings.vkt_chat_id,
             inline_kb=vkt_message.get('inlineKB', '')
         )
+    index.set_status(inc.idx, status)
 
 
-if __name__ == '__main__':
+def handle_callbacks(bot: vkt.Bot, events: list[dict], index: IncidentIndex, settings: Settings):
+    """
+    Обрабатывает коллбэки - нажатия на кнопки "пометить закрытым" и "пометить открытым".
+    Сначала сразу отвечает на все нажатия, чтобы у пользователей не крутился индикатор загрузки,
+    затем для каждого сообщения применяет только последнее нажатие.
+    Ответы и редактирования сообщений выполняются параллельно
+
+    :param bot: объект VK Teams бота
+    :param events: события callbackQuery
+    :param index: индекс уведомлений
+    :param settings: настройки бота
+    """
+    if not events:
+        return
+
+    with ThreadPoolExecutor(max_workers=CALLBACK_WORKERS, thread_name_prefix='callback') as executor:
+        answers = [executor.submit(bot.answer_callback_query, event['payload']['queryId']) for event in events]
+        for answer in wait(answers).done:
+            if answer.exception():
+                logger.warning(f'Failed to answer callback query: {answer.exception()!r}')
+
+        edits = [
+            executor.submit(apply_callback, bot, event, index, settings) for event in coalesce_callbacks(events).values()
+        ]
+        for edit in wait(edits).done:
+            # события уже вычитаны, поэтому ошибка одного редактирования не должна прерывать обработку остальных
+            # (и команд после коллбэков, см. handle_events)
+            if edit.exception():
+                logger.error(f'Failed to apply callback: {edit.exception()!r}')
+
+
+def handle_events(bot: vkt.Bot, coordinator: Coordinator, index: IncidentIndex, settings: Settings):
+    """
+    Вычитывает события бота и раздаёт их обработчикам:
+    нажатия кнопок - в handle_callbacks, команды поиска - в handle_commands.
+    События читаются одним запросом, потому что прочитанные события сервер повторно не отдаёт.
+    Если реплик бота несколько, то события обрабатывает только лидер
+
+    :param bot: объект VK Teams бота
+    :param coordinator: координатор реплик
+    :param index: индекс уведомлений
+    :param settings: настройки бота
+    :return: количество обработанных событий
+    """
+    if not coordinator.is_leader('callbacks', ttl=LEADER_TTL):
+        return 0
+
+    # продолжаем с того события, на котором остановился предыдущий лидер
+    bot.last_event_id = max(bot.last_event_id, int(coordinator.load('last_event_id') or 0))
+
+    # вычитываем события нажатий на callback-кнопки и новые сообщения с командами (см. bot api)
+    events = bot.get_events(['callbackQuery', 'newMessage'])
+    try:
+        handle_callbacks(bot, [e for e in events if e['type'] == 'callbackQuery'], index, settings)
+    except Exception:
+        # события уже вычитаны и повторно не придут - команды обрабатываем в любом случае
+        logger.exception('Failed to handle callbacks')
+    handle_commands(bot, [e for e in events if e['type'] == 'newMessage'], index, settings.command_chats)
+
+    # если за время обработки лидерство ушло другой реплике, то её курсор не трогаем,
+    # и в любом случае курсор не сдвигаем назад
+    if coordinator.is_leader('callbacks', ttl=LEADER_TTL):
+        last_event_id = max(bot.last_event_id, int(coordinator.load('last_event_id') or 0))
+        coordinator.save('last_event_id', str(last_event_id))
+    return len(events)
+
 
-    # подключаемся к exchange
-    creds = Credentials(username=os.environ['EXC_USER'], password=os.environ['EXC_PASSWORD'])
-    config = Configuration(
-        server=os.environ['EXC_SERVER'],
-        # retry_policy=FaultTolerance(max_wait=3600),
-        credentials=creds
+def main():
+    # настройки разбираем один раз, дальше передаём объект Settings
+    settings = Settings.from_env()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s\t%(name)s\t%(levelname)s\t%(message)s"
     )
-    acct = Account(
-        primary_smtp_address=os.environ['EXC_EMAIL'],
-        config=config,
-        autodiscover=True,
-        access_type=DELEGATE
+    vkt_logger.setup(
+        logging.getLogger(),
+        api_url=settings.vkt_base_url,
+        token=settings.vkt_bot_token,
+        chats=[settings.vkt_admin_id, ]
     )
+    logger.info(f'Starting, imports took {IMPORTED - STARTED:.2f} s')
+
+    # трассировка пути уведомления от письма до чата (опционально, см. tracing.py)
+    tracing.setup(file=settings.trace_file, otlp_endpoint=settings.otlp_endpoint)
+
+    # индекс для поиска по истории уведомлений, его наполняют обработчики писем
+    index = IncidentIndex(settings.index_db)
 
-    # получаем exchange-папки для писем инцидентов и мониторинга,
-    # затем создаём соответствующие обработчики этих папок
-    incident_folder = walk_mail(acct.inbox, os.environ.get('EXC_INC_FOLDER', ''))
-    monitoring_folder = walk_mail(acct.inbox, os.environ.get('EXC_MON_FOLDER', ''))
-    inc_handler = IncidentHandler(incident_folder)
-    mon_handler = MonitoringHandler(monitoring_folder)
+    # получаем (лениво, при первой проверке почты) exchange-папки для писем инцидентов и мониторинга,
+    # затем создаём соответствующие обработчики этих папок.
+    # Оба обработчика ходят в один и тот же exchange, поэтому предохранитель у них общий
+    exchange = Exchange(settings)
+    exchange_breaker = CircuitBreaker('Exchange', failure_threshold=3, recovery_timeout=60)
+    inc_handler = IncidentHandler(exchange.folder(settings.exc_inc_folder), breaker=exchange_breaker, index=index)
+    mon_handler = MonitoringHandler(exchange.folder(settings.exc_mon_folder), breaker=exchange_breaker, index=index)
 
-    # инициализируем бота VK Teams и очищаем накопившиеся на сервере события
+    # инициализируем бота VK Teams
     bot = vkt.Bot(
-        token=os.environ['VKT_BOT_TOKEN'],
-        base_url=os.environ.get('VKT_BASE_URL', '')
+        token=settings.vkt_bot_token,
+        base_url=settings.vkt_base_url,
+        breaker=CircuitBreaker('VK Teams', failure_threshold=5, recovery_timeout=30),
+        rate_limit=settings.vkt_rate_limit
     )
-    bot.get_events()
 
-    # создаём планировщик, который будет запускать обработчики по таймеру
-    scheduler = SafeScheduler(reschedule_on_failure=True, seconds_after_failure=5)
+    # координатор реплик: если задан общий файл COORD_DB, то реплики делят между собой
+    # папки с письмами и выбирают лидера для обработки коллбэков. Без него реплика одна и делает всё
+    coordinator = Coordinator(
+        SQLiteStore(settings.coord_db) if settings.coord_db else MemoryStore(),
+        replica_id=settings.replica_id
+    )
+
+    # очищаем накопившиеся на сервере события. Только если эта реплика - лидер:
+    # прочитанные события сервер повторно не отдаёт, а при работающем лидере это его необработанные события
+    if coordinator.is_leader('callbacks', ttl=LEADER_TTL):
+        bot.get_events()
+        last_event_id = max(bot.last_event_id, int(coordinator.load('last_event_id') or 0))
+        coordinator.save('last_event_id', str(last_event_id))
+
+    # очередь исходящих уведомлений: наполняется из почты, отправляется по приоритетам.
+    # Письма отмечаются прочитанными до отправки, поэтому очередь хранится в OUTBOX_DB
+    # и после перезапуска неотправленное досылается
+    outbox = PriorityOutbox(aging=settings.outbound_aging, path=settings.outbox_db, owner=settings.replica_id)
 
-    # запланируем раз в минуту проверять новые письма
-    # и раз в 2 секунды проверять новые события нажатия кнопок
-    scheduler.every(60).seconds.do(
-        handle_notifications, bot=bot, inc_handler=inc_handler, mon_handler=mon_handler
+    # создаём планировщик, который будет запускать обработчики по таймеру.
+    # При ошибках повторяем через 5 секунд, удваивая паузу вплоть до 10 минут.
+    # О разомкнутом предохранителе он уже сообщил сам, поэтому трейсбеки таких ошибок не логируем
+    scheduler = SafeScheduler(
+        reschedule_on_failure=True, seconds_after_failure=5, max_seconds_after_failure=600,
+        quiet_exceptions=(CircuitOpenError, )
+    )
+
+    # запланируем раз в минуту проверять новые письма (раз в 10 секунд, пока письма идут потоком)
+    # и раз в 2 секунды проверять новые события: нажатия кнопок и команды поиска.
+    # Первая проверка почты подключается к exchange - на это заложен запас в deadline
+    mail_job = scheduler.every(60).seconds.burst(10).deadline(120).do(
+        handle_notifications, outbox=outbox, inc_handler=inc_handler, mon_handler=mon_handler,
+        coordinator=coordinator
+    )
+    # каждую секунду отправляем накопившиеся уведомления, самые срочные первыми.
+    # Отправка идёт параллельно с вычиткой почты, поэтому критичное событие,
+    # вычитанное посреди шторма предупреждений, уходит следующим
+    scheduler.every(1).seconds.deadline(SEND_BUDGET * 2).do(
+        send_notifications, bot=bot, outbox=outbox, settings=settings
     )
-    scheduler.every(2).seconds.do(handle_callbacks, bot=bot)
+    scheduler.every(2).seconds.deadline(EVENTS_DEADLINE).do(
+        handle_events, bot=bot, coordinator=coordinator, index=index, settings=settings
+    )
+    # раз в 10 секунд досылаем сообщения, отложенные пока VK Teams был недоступен
+    scheduler.every(10).seconds.deadline(120).do(bot.flush_outbox)
+
+    # эндпоинт /health с возрастом последнего успешного запуска каждой задачи
+    # и временем до чата по классам приоритета уведомлений
+    if settings.health_port:
+        serve_health(scheduler, settings.health_port, outbox=outbox)
+
+    bot.send_message(r'Бот itsm2vk\_bot запущен', settings.vkt_admin_id)
+    logger.info(f'Started in {time.perf_counter() - STARTED:.2f} s')
 
-    bot.send_message(r'Бот itsm2vk\_bot запущен', os.environ['VKT_ADMIN_ID'])
+    # первую проверку почты запускаем сразу, не дожидаясь минуты
+    mail_job.next_run = dt.datetime.now()
 
     # запускаем работу бота
     while True:
         scheduler.run_pending()
         time.sleep(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from dataclasses import asdict
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+import tracing
+from dto import Notification, Incident, Monitoring
+
+
+logger = logging.getLogger(__name__)
+
+# классы приоритета исходящих уведомлений, от самого срочного
+CRITICAL, HIGH, NORMAL, LOW = range(4)
+CLASS_NAMES = ('critical', 'high', 'normal', 'low')
+
+# маппинг критичности события мониторинга на класс приоритета.
+# Незнакомая критичность (в сообщении она помечается ‼️) - обычный приоритет
+MONITORING_PRIORITY = {
+    'Critical': CRITICAL,
+    'Warning': LOW,
+}
+
+# маппинг приоритета инцидента из ITSM на класс приоритета (ключи в нижнем регистре)
+INCIDENT_PRIORITY = {
+    'критический': CRITICAL, 'critical': CRITICAL, '1': CRITICAL,
+    'высокий': HIGH, 'high': HIGH, '2': HIGH,
+    'средний': NORMAL, 'medium': NORMAL, '3': NORMAL,
+    'низкий': LOW, 'low': LOW, '4': LOW, '5': LOW,
+}
+
+# типы DTO по названию - в каком виде уведомления хранятся в базе очереди (см. PriorityOutbox)
+KINDS = {'incident': Incident, 'monitoring': Monitoring}
+
+
+def priority_class(notification: Notification) -> int:
+    """
+    :param notification: DTO инцидента или мониторинга
+    :return: класс приоритета, CRITICAL - самый срочный
+    """
+    if isinstance(notification, Monitoring):
+        return MONITORING_PRIORITY.get(notification.priority, NORMAL)
+    if isinstance(notification, Incident):
+        return INCIDENT_PRIORITY.get(notification.priority.strip().lower(), NORMAL)
+    return NORMAL
+
+
+class PriorityOutbox:
+    """
+    Очередь исходящих уведомлений с приоритетами.
+    Обработчики писем кладут в неё уведомления, а отправка (drain) каждый раз берёт самое срочное,
+    поэтому критичное событие, пришедшее посреди шторма предупреждений, уходит следующим,
+    а не ждёт, пока отправятся все накопившиеся предупреждения.
+
+    Чтобы менее срочные уведомления не голодали, учитывается и время ожидания:
+    один класс приоритета стоит aging секунд. Уведомление, прождавшее aging секунд,
+    обгоняет только что пришедшее уведомление классом выше, поэтому предупреждение (LOW)
+    ждёт свежих критичных не дольше 3 * aging секунд.
+    Это сводится к постоянному ключу сортировки: время постановки в очередь + класс * aging,
+    так что очередь - обычная куча, без пересортировки по мере старения.
+
+    Письмо отмечается прочитанным, как только уведомление попало в очередь, поэтому, если задан path,
+    очередь дублируется в SQLite и после перезапуска бота неотправленные уведомления загружаются обратно.
+    Из базы уведомление удаляется после отправки, так что прерванное посреди отправки уйдёт ещё раз
+    """
+
+    def __init__(self, aging: float = 30, window: int = 1000, clock: Callable[[], float] = time.time,
+                 path: str = '', owner: str = ''):
+        """
+        :param aging: сколько секунд ожидания стоит один класс приоритета. 0 - без приоритетов, по порядку (FIFO)
+        :param window: по скольким последним отправкам считать время до чата (см. metrics)
+        :param clock: источник времени (подменяется в симуляции, см. simulate)
+        :param path: путь к файлу базы. По умолчанию очередь живёт только в памяти
+        :param owner: чья это очередь (id реплики): в одном файле могут лежать очереди нескольких реплик
+        """
+        self.aging = aging
+        self.clock = clock
+        self.owner = owner
+        self._heap: List[Tuple[float, int, int, float, Notification]] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._time_to_chat = {name: deque(maxlen=window) for name in CLASS_NAMES}
+        self._sent = dict.fromkeys(CLASS_NAMES, 0)
+
+        self._conn = None
+        if path:
+            # соединение одно на всех, к нему обращаются задачи из разных потоков - защищаем блокировкой
+            self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            with self._lock, self._conn:
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute(
+                    'CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, owner TEXT NOT NULL, '
+                    'kind TEXT NOT NULL, priority INTEGER NOT NULL, queued_at REAL NOT NULL, data TEXT NOT NULL)'
+                )
+                rows = self._conn.execute(
+                    'SELECT id, kind, priority, queued_at, data FROM outbox WHERE owner = ? ORDER BY id', (owner, )
+                ).fetchall()
+                for rowid, kind, priority, queued_at, data in rows:
+                    # ключ пересчитываем: aging мог поменяться между запусками
+                    self._heap.append((queued_at + priority * aging, rowid, priority, queued_at,
+                                       KINDS[kind](**json.loads(data))))
+                heapq.heapify(self._heap)
+            if rows:
+                logger.info(f'Loaded {len(rows)} unsent notifications from {path}')
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._heap)
+
+    def put(self, notification: Notification):
+        """
+        Ставит уведомление в очередь на отправку
+
+        :param notification: DTO инцидента или мониторинга
+        """
+        priority = priority_class(notification)
+        now = self.clock()
+        with self._lock:
+            # порядковый номер - чтобы при равных ключах сохранялся порядок писем и не сравнивались DTO.
+            # Если очередь хранится в базе, то это id записи в ней
+            if self._conn:
+                kind = 'incident' if isinstance(notification, Incident) else 'monitoring'
+                with self._conn:
+                    seq = self._conn.execute(
+                        'INSERT INTO outbox (owner, kind, priority, queued_at, data) VALUES (?, ?, ?, ?, ?)',
+                        (self.owner, kind, priority, now, json.dumps(asdict(notification)))
+                    ).lastrowid
+            else:
+                seq = next(self._seq)
+            heapq.heappush(self._heap, (now + priority * self.aging, seq, priority, now, notification))
+
+    def _pop(self) -> Optional[Tuple[float, int, int, float, Notification]]:
+        with self._lock:
+            return heapq.heappop(self._heap) if self._heap else None
+
+    def _done(self, seq: int):
+        if self._conn:
+            with self._lock, self._conn:
+                self._conn.execute('DELETE FROM outbox WHERE id = ?', (seq, ))
+
+    def _record(self, priority: int, queued_at: float, sent_at: float):
+        name = CLASS_NAMES[priority]
+        with self._lock:
+            self._time_to_chat[name].append(sent_at - queued_at)
+            self._sent[name] += 1
+
+    def drain(self, send: Callable[[Notification], object], budget: float = 30,
+              paused: Callable[[], bool] = None, retry: Tuple[Type[Exception], ...] = ()) -> int:
+        """
+        Отправляет уведомления из очереди, каждый раз самое срочное на текущий момент
+
+        :param send: функция отправки одного уведомления
+        :param budget: сколько секунд максимум отправлять, остальное - в следующий запуск
+        :param paused: функция, при True которой отправку нужно приостановить
+                       (например, пока bot api недоступен - тогда уведомления ждут здесь, сохраняя приоритеты)
+        :param retry: ошибки отправки, после которых уведомление возвращается в очередь, а отправка прекращается
+                      до следующего запуска. Уведомление с любой другой ошибкой выбрасывается из очереди
+        :return: количество отправленных уведомлений
+        """
+        started = time.monotonic()
+        sent = 0
+        while time.monotonic() - started < budget and not (paused and paused()):
+            entry = self._pop()
+            if entry is None:
+                break
+            _, seq, priority, queued_at, notification = entry
+            try:
+                send(notification)
+            except retry as e:
+                # уведомление не ушло - возвращаем его с тем же ключом (и записью в базе) и ждём следующего запуска
+                with self._lock:
+                    heapq.heappush(self._heap, entry)
+                logger.warning(f'Failed to send {notification}: {e!r}, {len(self)} notifications are waiting')
+                break
+            except Exception as e:
+                # ошибка формирования сообщения повторится при каждой попытке - выбрасываем уведомление
+                logger.exception(f'Failed to send {notification}: {e!r}')
+                self._done(seq)
+                continue
+            self._done(seq)
+            sent_at = self.clock()
+            self._record(priority, queued_at, sent_at)
+            tracing.record('outbound.wait', queued_at, sent_at, trace_id=notification.trace_id,
+                           priority=CLASS_NAMES[priority])
+            sent += 1
+        if sent and len(self):
+            logger.info(f'Sent {sent} notifications, {len(self)} left in the queue')
+        return sent
+
+    def metrics(self) -> Dict[str, dict]:
+        """
+        :return: для каждого класса приоритета: сколько ждёт в очереди, сколько отправлено
+                 и время до чата (от постановки в очередь до отправки) по последним отправкам, в секундах
+        """
+        with self._lock:
+            queued = dict.fromkeys(CLASS_NAMES, 0)
+            for entry in self._heap:
+                queued[CLASS_NAMES[entry[2]]] += 1
+            result = {}
+            for name in CLASS_NAMES:
+                waits = sorted(self._time_to_chat[name])
+                result[name] = {
+                    'queued': queued[name],
+                    'sent': self._sent[name],
+                    'time_to_chat': {
+                        'p50': round(tracing.percentile(waits, 50), 3),
+                        'p90': round(tracing.percentile(waits, 90), 3),
+                        'max': round(waits[-1], 3),
+                    } if waits else None,
+                }
+            return result
+
+
+def simulate(count: int = 1000, arrival_rate: float = 100, send_rate: float = 10, aging: float = 30,
+             critical_share: float = 0.02, incident_share: float = 0.1, seed: int = 0) -> Dict[str, dict]:
+    """
+    Моделирует шторм уведомлений в виртуальном времени и измеряет время до чата по классам приоритета:
+    уведомления приходят быстрее, чем их можно отправить, основная масса - предупреждения мониторинга
+
+    :param count: сколько уведомлений в шторме
+    :param arrival_rate: сколько уведомлений приходит в секунду
+    :param send_rate: сколько уведомлений можно отправить в секунду
+    :param aging: см. PriorityOutbox, 0 - отправка по порядку
+    :param critical_share: доля критичных событий мониторинга
+    :param incident_share: доля инцидентов (с высоким приоритетом)
+    :param seed: зерно генератора случайных чисел
+    :return: PriorityOutbox.metrics() после отправки всех уведомлений
+    """
+    rnd = random.Random(seed)
+    now = [0.0]
+    outbox = PriorityOutbox(aging=aging, window=count, clock=lambda: now[0])
+
+    arrivals = []
+    for i in range(count):
+        roll = rnd.random()
+        if roll < critical_share:
+            notification = Monitoring(server=f'host{i}', priority='Critical')
+        elif roll < critical_share + incident_share:
+            notification = Incident(idx=f'INC{i}', priority='Высокий')
+        else:
+            notification = Monitoring(server=f'host{i}', priority='Warning')
+        arrivals.append((i / arrival_rate, notification))
+
+    def send(_):
+        now[0] += 1 / send_rate
+
+    pending = deque(arrivals)
+    while pending or len(outbox):
+        while pending and pending[0][0] <= now[0]:
+            outbox.put(pending.popleft()[1])
+        if not len(outbox):
+            now[0] = pending[0][0]
+            continue
+        # отправляем по одному, чтобы между отправками успевали приходить новые уведомления
+        outbox.drain(send, budget=float('inf'), paused=lambda: pending and pending[0][0] <= now[0])
+    return outbox.metrics()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Время до чата по классам приоритета при шторме уведомлений: по порядку и с приоритетами'
+    )
+    parser.add_argument('--count', type=int, default=1000, help='уведомлений в шторме')
+    parser.add_argument('--arrival-rate', type=float, default=100, help='приходит уведомлений в секунду')
+    parser.add_argument('--send-rate', type=float, default=10, help='отправляется уведомлений в секунду')
+    parser.add_argument('--aging', type=float, default=30, help='секунд ожидания на класс приоритета')
+    args = parser.parse_args()
+
+    print(f"{'ordering':<12}{'class':<10}{'sent':>6}{'p50, s':>10}{'p90, s':>10}{'max, s':>10}")
+    for ordering, aging in (('fifo', 0), ('priority', args.aging)):
+        metrics = simulate(args.count, args.arrival_rate, args.send_rate, aging)
+        for name, stats in metrics.items():
+            if stats['time_to_chat']:
+                ttc = stats['time_to_chat']
+                print(f"{ordering:<12}{name:<10}{stats['sent']:>6}{ttc['p50']:>10.1f}{ttc['p90']:>10.1f}{ttc['max']:>10.1f}")
@@ -0,0 +1,294 @@
+import argparse
+import datetime as dt
+import email
+import email.policy
+import email.utils
+import glob
+import html
+import logging
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from functools import partial
+from typing import Iterator, List, Optional, Tuple, Union
+
+import vkt
+from dto import Incident, Notification
+from incident_index import IncidentIndex
+from main import Exchange, send_notification
+from mail_handler import IncidentHandler, MonitoringHandler
+from settings import Settings
+
+
+logger = logging.getLogger('replay')
+
+# обработчики, правилами которых (отправитель и тема) письма раскладываются по типам
+HANDLERS = (IncidentHandler, MonitoringHandler)
+
+# письмо из exchange, вычитанное для разбора: (id, отправитель, тема, текст, время получения)
+MailTask = Tuple[str, str, str, str, float]
+
+
+@dataclass
+class Parsed:
+    """
+    Результат разбора одного письма в процессе-обработчике
+    """
+
+    status: str  # 'parsed', 'skipped' (не уведомление или вне диапазона дат), 'unrecognized'
+    received: float = 0  # время получения письма, unix-время
+    notification: Optional[Notification] = None
+
+
+def read_eml(path: str) -> MailTask:
+    """
+    Читает выгруженное письмо .eml
+
+    :param path: путь к файлу
+    :return: письмо в том же виде, что и вычитанное из exchange (ключ - путь к файлу)
+    """
+    with open(path, 'rb') as f:
+        msg = email.message_from_binary_file(f, policy=email.policy.default)
+
+    sender = email.utils.parseaddr(str(msg.get('From', '')))[1]
+    date = msg.get('Date')
+    received = email.utils.parsedate_to_datetime(str(date)).timestamp() if date else os.path.getmtime(path)
+
+    # разборщики рассчитаны на текстовое тело письма (как item.text_body в exchange),
+    # поэтому html-письма грубо превращаем в текст
+    body = msg.get_body(preferencelist=('plain', 'html'))
+    text = body.get_content() if body else ''
+    if body and body.get_content_type() == 'text/html':
+        text = html.unescape(re.sub(r'<[^>]+>', '', re.sub(r'(?i)<br\s*/?>|</p>', '\n', text)))
+    return path, sender, str(msg.get('Subject', '')), text, received
+
+
+def parse_mail(task: Union[str, MailTask], since: float = 0, until: float = float('inf')) -> Parsed:
+    """
+    Разбирает письмо теми же правилами и DTO, что и бот. Выполняется в процессе-обработчике
+
+    :param task: письмо из exchange или путь к .eml
+    :param since: начало диапазона дат, unix-время
+    :param until: конец диапазона дат, unix-время
+    :return: результат разбора
+    """
+    key, sender, subject, text, received = read_eml(task) if isinstance(task, str) else task
+    if not since <= received < until:
+        return Parsed('skipped')
+
+    for handler in HANDLERS:
+        if not handler.matches(sender, subject):
+            continue
+        notification = handler.Dto.from_notification(text)
+        if not notification:
+            return Parsed('unrecognized', received)
+        notification.trace_id = key
+        return Parsed('parsed', received, notification)
+    return Parsed('skipped')
+
+
+def exchange_mails(settings: Settings, folders: List[str], since: dt.datetime, until: dt.datetime) -> Iterator[MailTask]:
+    """
+    Вычитывает из exchange-папок все письма (прочитанные тоже) за диапазон дат
+
+    :param settings: настройки бота
+    :param folders: пути папок относительно "Входящих" (см. main.walk_mail)
+    :param since: начало диапазона
+    :param until: конец диапазона
+    :return: письма
+    """
+    from exchangelib import EWSDateTime
+
+    exchange = Exchange(settings)
+    date_range = (
+        EWSDateTime.from_datetime(since.astimezone(dt.timezone.utc)),
+        EWSDateTime.from_datetime(until.astimezone(dt.timezone.utc)),
+    )
+    seen = set()
+    for path in folders:
+        folder = exchange.folder(path)()
+        items = folder.filter(datetime_received__range=date_range) \
+            .only('id', 'sender', 'subject', 'text_body', 'datetime_received') \
+            .order_by('datetime_received')
+        for item in items.iterator():
+            # папки инцидентов и мониторинга могут совпадать - одно письмо не отправляем дважды
+            if item.id in seen:
+                continue
+            seen.add(item.id)
+            yield (item.id, item.sender.email_address if item.sender else '', item.subject or '',
+                   item.text_body or '', item.datetime_received.timestamp())
+
+
+def eml_files(paths: List[str]) -> List[str]:
+    """
+    :param paths: файлы .eml и папки с ними
+    :return: все файлы .eml, папки просматриваются рекурсивно
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '**', '*.eml'), recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def rate(count: int, seconds: float) -> str:
+    return f'{count} in {seconds:.1f} s ({count / seconds if seconds else 0:.1f}/s)'
+
+
+def replay(tasks: List[Union[str, MailTask]], since: dt.datetime, until: dt.datetime,
+           settings: Optional[Settings], workers: int, dry_run: bool,
+           index: Optional[IncidentIndex] = None, skip_known: bool = False, retry_for: float = 600) -> dict:
+    """
+    Разбирает письма пулом процессов и отправляет уведомления в VK Teams в порядке получения писем.
+    Отправленные уведомления добавляются в индекс, как и при обычной работе бота
+
+    :param tasks: письма из exchange или пути к .eml
+    :param since: начало диапазона дат
+    :param until: конец диапазона дат
+    :param settings: настройки бота (для пробного прогона не нужны)
+    :param workers: количество процессов для разбора писем
+    :param dry_run: только разобрать и сформировать сообщения, ничего не отправлять
+    :param index: индекс инцидентов (см. IncidentIndex)
+    :param skip_known: не отправлять инциденты, номера которых уже есть в индексе
+    :param retry_for: сколько секунд подряд ждать восстановления VK Teams, прежде чем бросить отправку
+    :return: статистика. sent - доставленные уведомления, failed - не сформированные или отвергнутые,
+             undelivered - оставшиеся неотправленными, когда VK Teams так и не восстановился
+    """
+    stats = {'mails': len(tasks), 'parsed': 0, 'skipped': 0, 'unrecognized': 0, 'known': 0,
+             'sent': 0, 'failed': 0, 'undelivered': 0}
+
+    started = time.perf_counter()
+    parse = partial(parse_mail, since=since.timestamp(), until=until.timestamp())
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(parse, tasks, chunksize=max(len(tasks) // (workers * 4), 1)))
+    for result in results:
+        stats[result.status] += 1
+    parse_time = time.perf_counter() - started
+    logger.info(f'Parsed {rate(len(tasks), parse_time)} with {workers} processes: '
+                f'{stats["parsed"]} notifications, {stats["unrecognized"]} unrecognized, {stats["skipped"]} skipped')
+
+    notifications = [result.notification for result in sorted(
+        (result for result in results if result.status == 'parsed'), key=lambda result: result.received
+    )]
+    if index and skip_known:
+        # известные номера определяем до отправки: повторные письма по инциденту из самого диапазона
+        # (например, переназначение) бот тоже отправил бы, их не пропускаем
+        known = {n.idx for n in notifications if isinstance(n, Incident) and index.known(n.idx)}
+        stats['known'] = sum(isinstance(n, Incident) and n.idx in known for n in notifications)
+        notifications = [n for n in notifications if not (isinstance(n, Incident) and n.idx in known)]
+        logger.info(f'{stats["known"]} notifications skipped: {len(known)} incidents are already in the index')
+
+    started = time.perf_counter()
+    if dry_run:
+        for notification in notifications:
+            notification.prep_vkt_message()
+            logger.info(f'[dry run] {notification}')
+    else:
+        # отправляем не чаще VKT_RATE_LIMIT сообщений в секунду. Уведомления не откладываются в bot.outbox:
+        # пока bot api недоступен, очередное уведомление ждёт здесь, так что порядок сохраняется,
+        # а отправленным и проиндексированным считается только то, что действительно дошло.
+        # В bot.outbox попадают только оставшиеся части уже начатых сообщений (см. vkt.PartialSendError)
+        bot = vkt.Bot(token=settings.vkt_bot_token, base_url=settings.vkt_base_url, rate_limit=settings.vkt_rate_limit)
+        queue = deque(notifications)
+        unavailable_since = None
+        while queue or bot.outbox:
+            try:
+                bot.flush_outbox()
+                if queue:
+                    notification = queue[0]
+                    try:
+                        send_notification(bot, notification, settings, postpone=False)
+                    except vkt.API_ERRORS:
+                        raise
+                    except Exception as e:
+                        stats['failed'] += 1
+                        logger.error(f'Failed to send {notification}: {e!r}')
+                    else:
+                        stats['sent'] += 1
+                        if index:
+                            index.add(notification)
+                        if stats['sent'] % 100 == 0:
+                            logger.info(f'Sent {rate(stats["sent"], time.perf_counter() - started)}')
+                    queue.popleft()
+                unavailable_since = None
+            except (vkt.PartialSendError, *vkt.API_ERRORS) as e:
+                unavailable_since = unavailable_since or time.monotonic()
+                left = unavailable_since + retry_for - time.monotonic()
+                if left <= 0:
+                    logger.error(f'VK Teams is unavailable for {retry_for:.0f} s, giving up: {e!r}')
+                    break
+                logger.warning(f'VK Teams is unavailable ({e!r}), {len(queue)} notifications are waiting')
+                time.sleep(min(bot.breaker.recovery_timeout if bot.breaker.is_open else 1, left))
+        stats['undelivered'] = len(queue)
+        if bot.outbox:
+            logger.error(f'{len(bot.outbox)} messages are sent partially, the rest is lost')
+    send_time = time.perf_counter() - started
+
+    logger.info(f'{"Rendered" if dry_run else "Sent"} {rate(len(notifications) - stats["undelivered"], send_time)}'
+                + (f', {stats["failed"]} failed' if stats['failed'] else '')
+                + (f', {stats["undelivered"]} undelivered' if stats['undelivered'] else ''))
+    stats.update(parse_seconds=round(parse_time, 3), send_seconds=round(send_time, 3))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Повторная отправка уведомлений за диапазон дат: из exchange-папок или из выгруженных .eml'
+    )
+    parser.add_argument('--since', type=dt.datetime.fromisoformat, required=True,
+                        help='начало диапазона, например 2024-03-01T08:00 (локальное время)')
+    parser.add_argument('--until', type=dt.datetime.fromisoformat, default=None,
+                        help='конец диапазона (не включительно), по умолчанию - сейчас')
+    parser.add_argument('--folder', action='append', default=[],
+                        help='exchange-папка относительно "Входящих", можно несколько. '
+                             'По умолчанию EXC_INC_FOLDER и EXC_MON_FOLDER')
+    parser.add_argument('--eml', nargs='+', default=[], help='файлы .eml или папки с ними вместо exchange')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='процессов для разбора писем')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='сообщений в секунду, по умолчанию VKT_RATE_LIMIT или 5')
+    parser.add_argument('--dry-run', action='store_true', help='только разобрать письма, ничего не отправлять')
+    parser.add_argument('--retry-for', type=float, default=600,
+                        help='сколько секунд подряд ждать восстановления VK Teams, прежде чем бросить отправку')
+    parser.add_argument('--skip-known', action='store_true',
+                        help='не отправлять инциденты, номера которых уже есть в индексе INDEX_DB')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s\t%(name)s\t%(levelname)s\t%(message)s")
+    # сами письма в лог не выводим, только итоги
+    logging.getLogger('mail_handler').setLevel(logging.WARNING)
+    logging.getLogger('vkt').setLevel(logging.WARNING)
+
+    since = args.since
+    until = args.until or dt.datetime.now()
+
+    # настройки нужны для exchange и для отправки, пробный прогон по .eml обходится без них
+    settings = None
+    if not (args.eml and args.dry_run):
+        settings = Settings.from_env()
+        settings = replace(settings, vkt_rate_limit=args.rate if args.rate is not None else settings.vkt_rate_limit or 5)
+
+    started = time.perf_counter()
+    if args.eml:
+        tasks = eml_files(args.eml)
+    else:
+        folders = args.folder or list(dict.fromkeys([settings.exc_inc_folder, settings.exc_mon_folder]))
+        tasks = list(exchange_mails(settings, folders, since, until))
+    logger.info(f'Read {rate(len(tasks), time.perf_counter() - started)} '
+                f'{"files" if args.eml else "mails"} for {since} - {until}')
+
+    # индекс нужен для отправки и для --skip-known. Без настроек (пробный прогон по .eml) путь к нему - из INDEX_DB
+    index = None
+    if args.skip_known or not args.dry_run:
+        index = IncidentIndex(settings.index_db if settings else os.environ.get('INDEX_DB', Settings.index_db))
+    stats = replay(tasks, since, until, settings, max(args.workers or 1, 1), args.dry_run, index, args.skip_known,
+                   args.retry_for)
+    logger.info(f'Done: {stats}')
+
+
+if __name__ == '__main__':
+    main()
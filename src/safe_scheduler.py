@@ -1,10 +1,78 @@
 import datetime as dt
 import logging
+import random
+import threading
+import time
 from traceback import format_exc
+from typing import Optional
 
 import schedule
 
 
+class AdaptiveJob(schedule.Job):
+    """
+    A Job that can adapt its own schedule:
+
+    - burst(seconds): if the job function returns a truthy value
+      (i.e. the last cycle found work), the next run happens after
+      `seconds` instead of the regular interval;
+    - deadline(seconds): the run must finish within `seconds`,
+      otherwise it's abandoned by the watchdog and counted as a failure.
+
+    Failures are backed off exponentially by SafeScheduler.
+    """
+
+    def __init__(self, interval: int, scheduler: Optional[schedule.Scheduler] = None):
+        super().__init__(interval, scheduler)
+        self.burst_interval: Optional[float] = None
+        self.max_run_time: Optional[float] = None
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+        self.started: Optional[float] = None
+        self.generation = 0
+        self.overrun_reported = False
+        self.consecutive_failures = 0
+        self.created = time.monotonic()
+        self.last_success: Optional[float] = None
+        self.stats = {
+            'runs': 0,
+            'busy_runs': 0,
+            'failures': 0,
+            'consecutive_failures': 0,
+            'overruns': 0,
+            'timeouts': 0,
+            'skipped_overlaps': 0,
+            'last_duration': None,
+            'last_success': None,
+            'last_decision': None,
+            'next_delay': None,
+        }
+
+    @property
+    def name(self) -> str:
+        return getattr(self.job_func, '__name__', repr(self.job_func))
+
+    def burst(self, seconds: float) -> 'AdaptiveJob':
+        """
+        Poll sooner (every `seconds`) while the job function keeps returning truthy values.
+        """
+        self.burst_interval = seconds
+        return self
+
+    def deadline(self, seconds: float) -> 'AdaptiveJob':
+        """
+        Maximum duration of a single run. Longer runs are abandoned.
+        """
+        self.max_run_time = seconds
+        return self
+
+    def _set_next_delay(self, decision: str, delay: float):
+        self.next_run = dt.datetime.now() + dt.timedelta(seconds=delay)
+        self.stats['last_decision'] = decision
+        self.stats['next_delay'] = round(delay, 3)
+        logging.debug("Job %s: %s, next run in %.1f s", self.name, decision, delay)
+
+
 class SafeScheduler(schedule.Scheduler):
     """
     An implementation of Scheduler that catches jobs that fail, logs their
@@ -13,33 +81,201 @@ class SafeScheduler(schedule.Scheduler):
 
     Use this to run jobs that may or may not crash without worrying about
     whether other jobs will run or if they'll crash the entire script.
+
+    Jobs created with every() are AdaptiveJobs: they can poll sooner while
+    they find work (burst mode), and consecutive failures are backed off
+    exponentially with jitter. Schedule decisions are available via metrics().
+
+    Every run happens in its own worker thread, so a hung job doesn't block
+    the others. run_pending() also acts as a watchdog: it warns about jobs
+    running longer than twice their interval and abandons jobs that exceed their
+    deadline. A thread can't be killed, so the abandoned run keeps going
+    in the background, but its result is ignored. The job is scheduled again,
+    but it won't start until the abandoned thread has actually exited.
     """
 
-    def __init__(self, reschedule_on_failure=True, minutes_after_failure=0, seconds_after_failure=0):
+    def __init__(self, reschedule_on_failure=True, minutes_after_failure=0, seconds_after_failure=0,
+                 max_seconds_after_failure=600, jitter=0.1, quiet_exceptions=()):
         """
         If reschedule_on_failure is True, jobs will be rescheduled for their
         next run as if they had completed successfully. If False, they'll run
         on the next run_pending() tick.
+
+        If minutes_after_failure/seconds_after_failure are set, a failed job is
+        retried after that delay, doubled on every consecutive failure up to
+        max_seconds_after_failure. The delay is randomized by +-jitter share
+        so that retries of different jobs don't line up.
+
+        Exceptions listed in quiet_exceptions are expected failures (e.g. an
+        open circuit breaker that has already reported itself): they are
+        backed off like any other failure, but logged without a traceback.
         """
         self.reschedule_on_failure = reschedule_on_failure
         self.minutes_after_failure = minutes_after_failure
         self.seconds_after_failure = seconds_after_failure
+        self.max_seconds_after_failure = max_seconds_after_failure
+        self.jitter = jitter
+        self.quiet_exceptions = tuple(quiet_exceptions)
+        self._lock = threading.RLock()
         super().__init__()
 
+    def every(self, interval: int = 1) -> AdaptiveJob:
+        return AdaptiveJob(interval, self)
+
+    def run_pending(self) -> None:
+        logs = []
+        with self._lock:
+            self._watchdog(logs)
+            super().run_pending()
+        self._log(logs)
+
+    @staticmethod
+    def _log(logs: list):
+        # records are collected under the lock and logged after releasing it:
+        # a handler may block for a long time (VKTLoggerHandler sends every record over HTTP)
+        for level, message in logs:
+            logging.log(level, message)
+
+    def _backoff_delay(self, failures: int) -> float:
+        base = self.minutes_after_failure * 60 + self.seconds_after_failure
+        delay = min(base * 2 ** (failures - 1), max(self.max_seconds_after_failure, base))
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
     def _run_job(self, job):
+        if job.running:
+            # the previous run hasn't finished yet - don't start another one on top of it
+            job.stats['skipped_overlaps'] += 1
+            job._set_next_delay('overlap', job.period.total_seconds())
+            return
+        if job.thread is not None and job.thread.is_alive():
+            # an abandoned run is still going: starting another one would process the same work twice
+            job.stats['skipped_overlaps'] += 1
+            job._set_next_delay('abandoned_alive', job.period.total_seconds())
+            return
+
+        job.running = True
+        job.started = time.monotonic()
+        job.overrun_reported = False
+        job.generation += 1
+        # while the job is running, the scheduler must not consider it overdue
+        job.next_run = dt.datetime.now() + job.period
+        job.thread = threading.Thread(
+            target=self._execute, args=(job, job.generation), name=f'job-{job.name}', daemon=True
+        )
+        job.thread.start()
+
+    def _execute(self, job, generation: int):
+        started = job.started
+        error = None
+        ret = None
+        quiet = False
         try:
-            super()._run_job(job)
+            # job.run() is not used: it reschedules the job itself,
+            # and for an abandoned run that would overwrite the new schedule
+            ret = job.job_func()
+        except self.quiet_exceptions as e:
+            error = "Job %s failed: %s" % (job.name, e)
+            quiet = True
         except Exception:
-            logging.error(format_exc())
-            if self.reschedule_on_failure:
-                if self.minutes_after_failure != 0 or self.seconds_after_failure != 0:
-                    logging.warning("Rescheduled in %s minutes and %s seconds." % (self.minutes_after_failure, self.seconds_after_failure))
-                    job.last_run = None
-                    job.next_run = dt.datetime.now() + dt.timedelta(minutes=self.minutes_after_failure, seconds=self.seconds_after_failure)
-                else:
-                    logging.warning("Rescheduled.")
-                    job.last_run = dt.datetime.now()
-                    job._schedule_next_run()
+            error = format_exc()
+
+        logs = []
+        with self._lock:
+            if job.generation != generation or not job.running:
+                # the run was abandoned by the watchdog, its result is no longer needed
+                logs.append((logging.WARNING, "Abandoned run of job %s finished after %.1f s."
+                             % (job.name, time.monotonic() - started)))
+            elif error:
+                job.running = False
+                job.stats['last_duration'] = round(time.monotonic() - started, 3)
+                self._on_failure(job, error, logs, quiet)
             else:
-                logging.warning("Job canceled.")
-                self.cancel_job(job)
+                job.running = False
+                job.stats['last_duration'] = round(time.monotonic() - started, 3)
+                job.last_run = dt.datetime.now()
+                job._schedule_next_run()
+                if job._is_overdue(job.next_run):
+                    ret = schedule.CancelJob
+                self._on_success(job, ret)
+        self._log(logs)
+
+    def _watchdog(self, logs: list):
+        now = time.monotonic()
+        for job in list(self.jobs):
+            if not job.running:
+                continue
+            elapsed = now - job.started
+            if job.max_run_time is not None and elapsed > job.max_run_time:
+                # abandon the hung run: the thread keeps going, but its result will be ignored
+                job.running = False
+                job.stats['timeouts'] += 1
+                self._on_failure(job, "Job %s timed out after %.1f s (deadline %s s), abandoned."
+                                 % (job.name, elapsed, job.max_run_time), logs)
+            elif elapsed > 2 * job.period.total_seconds() and not job.overrun_reported:
+                job.overrun_reported = True
+                job.stats['overruns'] += 1
+                logs.append((logging.WARNING, "Job %s is running for %.1f s, more than twice its interval."
+                             % (job.name, elapsed)))
+
+    def _on_success(self, job, ret):
+        if isinstance(ret, schedule.CancelJob) or ret is schedule.CancelJob:
+            self.cancel_job(job)
+            return
+
+        job.consecutive_failures = 0
+        job.last_success = time.monotonic()
+        job.stats['runs'] += 1
+        job.stats['consecutive_failures'] = 0
+        job.stats['last_success'] = dt.datetime.now()
+        if ret and job.burst_interval is not None:
+            # the last cycle found work - come back sooner
+            job.stats['busy_runs'] += 1
+            job._set_next_delay('burst', job.burst_interval)
+        else:
+            job._set_next_delay('interval', (job.next_run - dt.datetime.now()).total_seconds())
+
+    def _on_failure(self, job, error: str, logs: list, quiet: bool = False):
+        logs.append((logging.DEBUG if quiet else logging.ERROR, error))
+        job.consecutive_failures += 1
+        job.stats['runs'] += 1
+        job.stats['failures'] += 1
+        job.stats['consecutive_failures'] = job.consecutive_failures
+
+        if self.reschedule_on_failure:
+            if self.minutes_after_failure != 0 or self.seconds_after_failure != 0:
+                delay = self._backoff_delay(job.consecutive_failures)
+                logs.append((logging.DEBUG if quiet else logging.WARNING, "Rescheduled in %.1f seconds." % delay))
+                job.last_run = None
+                job._set_next_delay('backoff', delay)
+            else:
+                logs.append((logging.WARNING, "Rescheduled."))
+                job.last_run = dt.datetime.now()
+                job._schedule_next_run()
+        else:
+            logs.append((logging.WARNING, "Job canceled."))
+            self.cancel_job(job)
+
+    def metrics(self) -> dict:
+        """
+        Schedule decisions and run statistics of every job.
+        """
+        with self._lock:
+            return {job.name: {**job.stats, 'next_run': job.next_run} for job in self.jobs}
+
+    def health(self) -> dict:
+        """
+        Age of the last successful run of every job (seconds, None if it never succeeded)
+        and whether it's stale: no success for 3 intervals plus the deadline.
+        """
+        now = time.monotonic()
+        report = {}
+        with self._lock:
+            for job in self.jobs:
+                last_success = job.last_success if job.last_success is not None else job.created
+                allowed_age = 3 * job.period.total_seconds() + (job.max_run_time or 0)
+                report[job.name] = {
+                    'last_success_age': round(now - job.last_success, 3) if job.last_success is not None else None,
+                    'running_for': round(now - job.started, 3) if job.running else None,
+                    'stale': now - last_success > allowed_age,
+                }
+        return report
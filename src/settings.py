@@ -0,0 +1,97 @@
+import os
+from dataclasses import dataclass, fields
+from typing import Mapping, Optional
+
+from dotenv import load_dotenv
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Настройки бота. Разбираются из переменных окружения (и .env) один раз при старте,
+    дальше по коду передаётся этот объект, а не читается os.environ.
+    Имена полей - имена переменных окружения в нижнем регистре (см. .env.example)
+    """
+
+    # exchange
+    exc_server: str
+    exc_email: str
+    exc_user: str
+    exc_password: str
+    exc_inc_folder: str = ''
+    exc_mon_folder: str = ''
+    exc_autodiscover: bool = True
+    exc_timeout: int = 60
+
+    # vk teams
+    vkt_bot_token: str = ''
+    vkt_chat_id: str = ''
+    vkt_monitoring_chat_id: str = ''
+    vkt_admin_id: str = ''
+    vkt_base_url: str = 'https://api.internal.myteam.mail.ru/bot/v1/'
+    # дополнительные чаты (через запятую), в которых бот отвечает на команды поиска
+    vkt_command_chats: str = ''
+    # не больше стольких сообщений в секунду, 0 - без ограничения
+    vkt_rate_limit: float = 0
+    # сколько секунд ожидания в очереди стоит один класс приоритета уведомления (см. outbound.py)
+    outbound_aging: float = 30
+
+    # инфраструктура
+    health_port: Optional[int] = None
+    coord_db: str = ''
+    replica_id: str = ''
+    index_db: str = 'incidents.sqlite3'
+    # файл, в котором очередь исходящих уведомлений переживает перезапуск, '' - только в памяти
+    outbox_db: str = ''
+
+    # трассировка (см. tracing.py): json-lines файл и/или адрес OTLP-коллектора
+    trace_file: str = ''
+    otlp_endpoint: str = ''
+
+    # переменные без значения по умолчанию, без которых бот не запустится
+    required = (
+        'exc_server', 'exc_email', 'exc_user', 'exc_password',
+        'vkt_bot_token', 'vkt_chat_id', 'vkt_monitoring_chat_id', 'vkt_admin_id',
+    )
+
+    @property
+    def command_chats(self) -> frozenset:
+        """
+        Чаты, в которых бот отвечает на команды поиска: чаты уведомлений, чат логов и VKT_COMMAND_CHATS
+        """
+        chats = [self.vkt_chat_id, self.vkt_monitoring_chat_id, self.vkt_admin_id]
+        chats += [chat.strip() for chat in self.vkt_command_chats.split(',')]
+        return frozenset(chat for chat in chats if chat)
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str] = None) -> 'Settings':
+        """
+        Собирает настройки из переменных окружения
+
+        :param env: переменные окружения. Если не передать, то берутся из os.environ,
+                    предварительно дополненные файлом .env
+        :return: настройки
+        :raises ValueError: если не заданы обязательные переменные
+        """
+        if env is None:
+            load_dotenv()
+            env = os.environ
+
+        missing = [name.upper() for name in cls.required if not env.get(name.upper())]
+        if missing:
+            raise ValueError('Required environment variables are not set: ' + ', '.join(missing))
+
+        values = {}
+        for field in fields(cls):
+            raw = env.get(field.name.upper())
+            if raw is None or raw == '':
+                continue
+            if field.type is bool:
+                values[field.name] = raw.strip().lower() in ('1', 'true', 'yes', 'on')
+            elif field.type in (int, Optional[int]):
+                values[field.name] = int(raw)
+            elif field.type is float:
+                values[field.name] = float(raw)
+            else:
+                values[field.name] = raw
+        return cls(**values)
@@ -0,0 +1,50 @@
+import argparse
+import time
+from typing import Dict
+
+from dto import Incident
+from vkt import MAX_MESSAGE_LENGTH, split_message
+
+
+# строки описания инцидентов разного вида: обычный текст, пересланное письмо с адресами в угловых скобках
+# и подстановками из шаблонов ITSM, и текст с настоящей разметкой
+LINES = {
+    'plain': 'Пользователь не может войти в VK Teams, ошибка при авторизации на рабочей станции\n',
+    'forwarded': 'From: Иванов Иван <ivanov@lukoil.com> Sent: сервер <Server01>, задание <job> упало\n',
+    'markup': '<b>Сервер</b> <i>srv01</i>: <code>disk /var 95%</code> <a href="https://itsm/inc">заявка</a>\n',
+}
+
+
+def benchmark(kind: str, size: int, limit: int = MAX_MESSAGE_LENGTH) -> Dict[str, float]:
+    """
+    Формирует сообщение об инциденте с описанием размером около size символов и нарезает его на части
+
+    :param kind: вид описания, ключ LINES
+    :param size: размер описания в символах
+    :param limit: максимальная длина одной части
+    :return: количество частей, длина самой длинной из них и время нарезки в миллисекундах
+    """
+    line = LINES[kind]
+    incident = Incident(idx='INC0000001', priority='Высокий', family_name='Иванов', name='Иван',
+                        parent_name='Иванович', org_unit='ООО "ЛУКОЙЛ-Технологии"', subject='Длинное описание',
+                        description=line * (size // len(line) + 1), link='https://itsm/inc')
+    text = incident.prep_vkt_message()['text']
+
+    started = time.process_time()
+    parts = split_message(text, limit)
+    elapsed = time.process_time() - started
+    return {'chars': len(text), 'parts': len(parts), 'max_part': max(map(len, parts)), 'ms': elapsed * 1000}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нарезка длинных сообщений об инцидентах на части для VK Teams')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4_000, 22_000, 80_000, 500_000],
+                        help='размеры описаний в символах')
+    parser.add_argument('--limit', type=int, default=MAX_MESSAGE_LENGTH, help='максимальная длина части')
+    args = parser.parse_args()
+
+    print(f"{'kind':<12}{'chars':>10}{'parts':>8}{'max part':>10}{'ms':>10}")
+    for kind in LINES:
+        for size in args.sizes:
+            stats = benchmark(kind, size, args.limit)
+            print(f"{kind:<12}{stats['chars']:>10}{stats['parts']:>8}{stats['max_part']:>10}{stats['ms']:>10.1f}")
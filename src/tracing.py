@@ -0,0 +1,459 @@
+"""
+Лёгкая трассировка пути уведомления от письма до сообщения в чате.
+
+Каждый этап обработки (ожидание в ящике, вычитка, разбор письма, формирование и отправка сообщения)
+записывается спаном: имя этапа, время начала и конца, атрибуты.
+Спаны одного письма объединяются ключом трассы - id письма в exchange
+(для редактирований по кнопкам - номером инцидента).
+
+Пока трассировка не настроена (см. setup), span() ничего не делает и почти ничего не стоит.
+
+Запуск как скрипта:
+    python tracing.py report traces.jsonl        - перцентили длительности по этапам
+    python tracing.py collect --file traces.jsonl - заглушка OTLP-коллектора, пишет спаны в файл
+"""
+import argparse
+import contextvars
+import hashlib
+import json
+import logging
+import math
+import os
+import queue
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, Iterator, List
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+# ключ текущей трассы. contextvar, а не глобальная переменная: задачи планировщика идут в разных потоках
+_trace_id: contextvars.ContextVar[str] = contextvars.ContextVar('trace_id', default='')
+
+_exporters: List['Exporter'] = []
+
+
+class Exporter(ABC):
+    """
+    Получатель завершённых спанов.
+    Напрямую не используется, используются дочерние классы - конкретные реализации
+    """
+
+    @abstractmethod
+    def export(self, span: dict):
+        """
+        :param span: словарь с полями trace_id, name, start, end (unix-время в секундах) и attrs
+        """
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class JsonLinesExporter(Exporter):
+    """
+    Дописывает спаны в файл, по одному json на строку.
+    Когда файл дорастает до max_bytes, он переименовывается в path.1 (path.1 - в path.2 и т.д.,
+    самый старый удаляется) и начинается новый, так что на диске не больше (backups + 1) * max_bytes
+    """
+
+    def __init__(self, path: str, max_bytes: int = 50 * 1024 * 1024, backups: int = 3):
+        """
+        :param path: путь к файлу
+        :param max_bytes: размер файла, после которого он ротируется. 0 - без ротации
+        :param backups: сколько старых файлов хранить
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = open(path, 'a', encoding='utf-8', buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, span: dict):
+        line = json.dumps(span, ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            if self.max_bytes and self._file.tell() >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8', buffering=1)
+
+    def shutdown(self):
+        with self._lock:
+            self._file.close()
+
+
+class OtlpExporter(Exporter):
+    """
+    Отправляет спаны в OTLP-совместимый коллектор (OTLP/HTTP, json) пачками из фонового потока,
+    чтобы недоступный коллектор не тормозил обработку писем.
+    Если коллектор не успевает, то лишние спаны выбрасываются
+    """
+
+    def __init__(self, endpoint: str, service_name: str = 'itsm2vk_bot',
+                 batch_size: int = 100, interval: float = 5, queue_size: int = 10000):
+        """
+        :param endpoint: адрес коллектора, например http://collector:4318 (путь /v1/traces добавится сам)
+        :param service_name: имя сервиса в ресурсе спанов
+        :param batch_size: сколько спанов отправлять одним запросом
+        :param interval: как часто отправлять накопившиеся спаны, в секундах
+        :param queue_size: сколько спанов держать в очереди на отправку
+        """
+        self.url = endpoint.rstrip('/')
+        if not self.url.endswith('/v1/traces'):
+            self.url += '/v1/traces'
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._run, name='otlp-exporter', daemon=True)
+        self._thread.start()
+
+    def export(self, span: dict):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self._dropped += 1
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._thread.join(timeout=self.interval + 10)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    span = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if span is None:
+                    stopping = True
+                    break
+                batch.append(span)
+            if batch:
+                self._send(batch)
+
+    def _send(self, batch: List[dict]):
+        try:
+            requests.post(self.url, json=to_otlp(batch, self.service_name), timeout=10).raise_for_status()
+        except requests.RequestException as e:
+            logger.debug(f'Failed to export {len(batch)} spans to {self.url}: {e!r}')
+        if self._dropped:
+            logger.debug(f'{self._dropped} spans dropped, OTLP exporter queue is full')
+            self._dropped = 0
+
+
+def _hex_id(value: str, length: int) -> str:
+    # OTLP требует id трассы из 16 байт и id спана из 8 байт в hex - получаем их из нашего ключа
+    return hashlib.md5(value.encode()).hexdigest()[:length]
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _from_otlp_value(value: dict) -> Any:
+    if 'intValue' in value:
+        return int(value['intValue'])
+    return next(iter(value.values()), '')
+
+
+def to_otlp(spans: Iterable[dict], service_name: str) -> dict:
+    """
+    Упаковывает спаны в тело запроса OTLP/HTTP json
+
+    :param spans: спаны в формате этого модуля
+    :param service_name: имя сервиса
+    :return: словарь ExportTraceServiceRequest
+    """
+    otlp_spans = []
+    for span in spans:
+        attributes = [{'key': 'trace.key', 'value': _otlp_value(span['trace_id'])}]
+        attributes += [{'key': key, 'value': _otlp_value(value)} for key, value in span['attrs'].items()]
+        otlp_spans.append({
+            'traceId': _hex_id(span['trace_id'] or span['name'], 32),
+            'spanId': _hex_id(f"{span['trace_id']}/{span['name']}/{span['start']}", 16),
+            'name': span['name'],
+            'kind': 1,
+            'startTimeUnixNano': str(int(span['start'] * 1e9)),
+            'endTimeUnixNano': str(int(span['end'] * 1e9)),
+            'attributes': attributes,
+        })
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]},
+        'scopeSpans': [{'scope': {'name': __name__}, 'spans': otlp_spans}],
+    }]}
+
+
+def from_otlp(body: dict) -> Iterator[dict]:
+    """
+    Распаковывает тело запроса OTLP/HTTP json обратно в спаны этого модуля (для заглушки коллектора)
+
+    :param body: словарь ExportTraceServiceRequest
+    :return: спаны
+    """
+    for resource_spans in body.get('resourceSpans', []):
+        for scope_spans in resource_spans.get('scopeSpans', []):
+            for span in scope_spans.get('spans', []):
+                attrs = {attr['key']: _from_otlp_value(attr['value']) for attr in span.get('attributes', [])}
+                yield {
+                    'trace_id': attrs.pop('trace.key', span.get('traceId', '')),
+                    'name': span['name'],
+                    'start': int(span['startTimeUnixNano']) / 1e9,
+                    'end': int(span['endTimeUnixNano']) / 1e9,
+                    'attrs': attrs,
+                }
+
+
+def setup(file: str = '', otlp_endpoint: str = ''):
+    """
+    Включает трассировку
+
+    :param file: путь к json-lines файлу для спанов (опционально)
+    :param otlp_endpoint: адрес OTLP-коллектора (опционально)
+    """
+    if file:
+        _exporters.append(JsonLinesExporter(file))
+        logger.info(f'Tracing to {file}')
+    if otlp_endpoint:
+        _exporters.append(OtlpExporter(otlp_endpoint))
+        logger.info(f'Tracing to {otlp_endpoint}')
+
+
+def shutdown():
+    """
+    Дописывает и отправляет накопившиеся спаны, выключает трассировку
+    """
+    while _exporters:
+        _exporters.pop().shutdown()
+
+
+def enabled() -> bool:
+    return bool(_exporters)
+
+
+def current_trace() -> str:
+    """
+    :return: ключ текущей трассы или пустая строка
+    """
+    return _trace_id.get()
+
+
+@contextmanager
+def trace(trace_id: str):
+    """
+    Делает trace_id ключом трассы для всех спанов внутри блока with
+
+    :param trace_id: id письма в exchange или номер инцидента
+    """
+    token = _trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+def record(name: str, start: float, end: float, trace_id: str = None, **attrs):
+    """
+    Записывает спан с заранее известными границами,
+    например время ожидания письма в ящике: от получения письма сервером до вычитки ботом
+
+    :param name: название этапа
+    :param start: начало, unix-время в секундах
+    :param end: конец, unix-время в секундах
+    :param trace_id: ключ трассы, по умолчанию текущий (см. trace)
+    :param attrs: атрибуты спана
+    """
+    if not _exporters:
+        return
+    span = {
+        'trace_id': current_trace() if trace_id is None else trace_id,
+        'name': name,
+        'start': start,
+        'end': end,
+        'attrs': attrs,
+    }
+    for exporter in _exporters:
+        try:
+            exporter.export(span)
+        except Exception as e:
+            # трассировка не должна ломать обработку писем
+            logger.debug(f'Failed to export span {name}: {e!r}')
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[dict]:
+    """
+    Замеряет длительность блока with и записывает её спаном с текущим ключом трассы.
+    Внутри блока в атрибуты можно дописать результат:
+
+        with tracing.span('vkt.send', chat_id=chat_id) as attrs:
+            attrs['msg_id'] = ...
+
+    :param name: название этапа
+    :param attrs: атрибуты спана
+    :return: словарь атрибутов спана
+    """
+    if not _exporters:
+        yield attrs
+        return
+    start = time.time()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs['error'] = repr(e)
+        raise
+    finally:
+        record(name, start, time.time(), **attrs)
+
+
+def load(paths: Iterable[str]) -> List[dict]:
+    """
+    :param paths: json-lines файлы со спанами
+    :return: спаны из всех файлов
+    """
+    spans = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+    return spans
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Перцентиль методом ближайшего ранга
+
+    :param values: отсортированные значения
+    :param q: перцентиль от 0 до 100
+    """
+    rank = max(math.ceil(len(values) * q / 100) - 1, 0)
+    return values[rank]
+
+
+def breakdown(spans: List[dict]) -> Dict[str, List[float]]:
+    """
+    Собирает длительности в миллисекундах по этапам.
+    Кроме этапов считает сквозные задержки по трассам, в которых есть отправка сообщения:
+    'total: mail → chat' - от получения письма сервером до отправки последней части сообщения,
+    'total: fetch → chat' - то же, но от вычитки письма ботом, то есть без ожидания в ящике
+
+    :param spans: спаны
+    :return: словарь {этап: длительности}
+    """
+    durations = defaultdict(list)
+    traces = defaultdict(list)
+    for item in spans:
+        durations[item['name']].append((item['end'] - item['start']) * 1000)
+        if item['trace_id']:
+            traces[item['trace_id']].append(item)
+
+    for trace_spans in traces.values():
+        sent = [s['end'] for s in trace_spans if s['name'] == 'vkt.send' and not s['attrs'].get('postponed')]
+        if not sent:
+            continue
+        for total, stage in (('total: mail → chat', 'mail.received'), ('total: fetch → chat', 'mail.fetch')):
+            starts = [s['start'] for s in trace_spans if s['name'] == stage]
+            if starts:
+                durations[total].append((max(sent) - min(starts)) * 1000)
+    return durations
+
+
+def report(spans: List[dict], out=sys.stdout):
+    """
+    Печатает таблицу перцентилей длительности по этапам
+    """
+    rows = sorted(breakdown(spans).items(), key=lambda row: (row[0].startswith('total'), row[0]))
+    out.write(f"{'stage':<22}{'count':>8}{'p50, ms':>12}{'p90, ms':>12}{'p99, ms':>12}{'max, ms':>12}\n")
+    for name, values in rows:
+        values.sort()
+        out.write(
+            f'{name:<22}{len(values):>8}'
+            + ''.join(f'{percentile(values, q):>12.1f}' for q in (50, 90, 99))
+            + f'{values[-1]:>12.1f}\n'
+        )
+
+
+def serve_collector(path: str, port: int = 4318, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """
+    Заглушка OTLP-коллектора: принимает спаны по OTLP/HTTP json (POST /v1/traces)
+    и дописывает их в json-lines файл, который потом можно разобрать командой report.
+    Нужна, чтобы проверить выгрузку в OTLP без настоящего коллектора
+
+    :param path: файл для спанов
+    :param port: порт сервера
+    :param host: адрес, на котором слушает сервер
+    :return: сервер (запускать serve_forever)
+    """
+    exporter = JsonLinesExporter(path)
+
+    class CollectorHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.rstrip('/') != '/v1/traces':
+                self.send_error(404)
+                return
+            if 'json' not in self.headers.get('Content-Type', ''):
+                self.send_error(415, 'only OTLP/HTTP json is supported')
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                for item in from_otlp(body):
+                    exporter.export(item)
+            except (ValueError, KeyError) as e:
+                self.send_error(400, str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), CollectorHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Трассировка пути уведомления от письма до чата')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    report_parser = commands.add_parser('report', help='перцентили длительности по этапам')
+    report_parser.add_argument('files', nargs='+', help='json-lines файлы со спанами')
+
+    collect_parser = commands.add_parser('collect', help='заглушка OTLP-коллектора')
+    collect_parser.add_argument('--file', default=os.environ.get('TRACE_FILE') or 'traces.jsonl',
+                                help='файл для спанов')
+    collect_parser.add_argument('--port', type=int, default=4318)
+
+    args = parser.parse_args()
+    if args.command == 'report':
+        report(load(args.files))
+    else:
+        print(f'Collecting OTLP spans on :{args.port}/v1/traces into {args.file}')
+        serve_collector(args.file, args.port).serve_forever()
@@ -1,10 +1,187 @@
 import logging
+import re
+import threading
+import time
+from collections import deque
+from typing import Generator, Union
 
 import requests
 
+import tracing
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
 
 logger = logging.getLogger(__name__)
 
+# максимальная длина текста одного сообщения VK Teams (см. bot api)
+MAX_MESSAGE_LENGTH = 4096
+
+# ошибки недоступности bot api: с ними сообщение имеет смысл отправить ещё раз позже
+API_ERRORS = (CircuitOpenError, requests.RequestException)
+
+# теги, которые понимает VK Teams (parseMode=HTML). Только их закрываем и переоткрываем при разрезе:
+# в тексте писем из ITSM встречаются неэкранированные <ivanov@lukoil.com> и <Server01>, которые тегами не являются
+SUPPORTED_TAGS = ('b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del', 'a', 'code', 'pre',
+                  'blockquote', 'ol', 'ul', 'li', 'span')
+
+# теги и html-сущности, внутри которых резать текст нельзя
+_MARKUP_RE = re.compile(r'<[^<>]*>|&#?\w+;')
+_TAG_RE = re.compile(r'<(/?)(' + '|'.join(SUPPORTED_TAGS) + r')(?=[\s/>])[^<>]*?(/?)>', re.IGNORECASE)
+
+
+def _open_tags(html: str, start: int, end: int, stack: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """
+    Возвращает стек тегов, оставшихся незакрытыми после куска разметки html[start:end]
+
+    :param html: HTML-разметка
+    :param start: начало куска
+    :param end: конец куска
+    :param stack: стек тегов, открытых до начала куска
+    :return: список пар (имя тега, открывающий тег целиком)
+    """
+    stack = list(stack)
+    for match in _TAG_RE.finditer(html, start, end):
+        closing, name, self_closing = match.group(1), match.group(2).lower(), match.group(3)
+        if self_closing:
+            continue
+        if not closing:
+            stack.append((name, match.group(0)))
+            continue
+        # закрывающий тег снимает со стека всё до соответствующего открывающего
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i][0] == name:
+                del stack[i:]
+                break
+    return stack
+
+
+def _find_cut(html: str, start: int, budget: int) -> int:
+    """
+    Ищет позицию, по которой можно разрезать разметку так,
+    чтобы кусок html[start:позиция] был не длиннее budget символов.
+    Предпочитает границы абзацев, затем строк, затем слов.
+    Никогда не режет внутри тега или html-сущности
+
+    :param html: HTML-разметка
+    :param start: начало куска
+    :param budget: максимальная длина куска
+    :return: позиция разреза
+    """
+    end = start + budget
+    unsafe = []
+    for match in _MARKUP_RE.finditer(html, start):
+        if match.start() >= end:
+            break
+        unsafe.append((match.start(), match.end()))
+
+    def inside_markup(pos: int) -> Union[tuple[int, int], None]:
+        for markup_start, markup_end in unsafe:
+            if markup_start < pos < markup_end:
+                return markup_start, markup_end
+        return None
+
+    # ищем разделитель во второй половине допустимого куска,
+    # чтобы не плодить слишком короткие сообщения
+    for sep in ('\n\n', '\n', ' '):
+        pos = html.rfind(sep, start + budget // 2, end)
+        while pos != -1 and inside_markup(pos):
+            pos = html.rfind(sep, start + budget // 2, pos)
+        if pos > start:
+            return pos
+
+    # разделителей нет - режем жёстко, но не посреди тега/сущности
+    markup = inside_markup(end)
+    if markup and markup[0] > start:
+        return markup[0]
+    return end
+
+
+def _iter_parts(text: str, limit: int) -> Generator[tuple[str, str], None, None]:
+    """
+    Нарезает HTML-текст на части, которые вместе с закрывающими тегами
+    укладываются в limit символов.
+    Теги переоткрываются и закрываются, только пока занимают не больше половины части,
+    иначе дальше текст режется без них
+
+    :param text: HTML-разметка
+    :param limit: максимальная длина одной части
+    :return: генератор пар (часть без закрывающих тегов, закрывающие теги)
+    """
+    start = 0
+    stack = []
+    while True:
+        reopen = ''.join(tag for _, tag in stack)
+        if len(reopen) > limit // 2:
+            stack, reopen = [], ''
+        if len(reopen) + len(text) - start <= limit:
+            yield reopen + text[start:], ''
+            return
+
+        budget = limit - len(reopen)
+        while True:
+            cut = _find_cut(text, start, budget)
+            cut_stack = _open_tags(text, start, cut, stack)
+            closing = ''.join(f'</{name}>' for name, _ in reversed(cut_stack))
+            if len(reopen) + cut - start + len(closing) <= limit:
+                break
+            if len(reopen) + len(closing) > limit // 2:
+                # закрывающие теги не помещаются - часть уходит без них
+                cut_stack, closing = [], ''
+                cut = _find_cut(text, start, limit - len(reopen))
+                break
+            budget = min(budget - 1, limit - len(reopen) - len(closing))
+
+        yield reopen + text[start:cut].rstrip(), closing
+
+        stack = cut_stack
+        start = cut
+        while start < len(text) and text[start].isspace():
+            start += 1
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    """
+    Разбивает HTML-текст сообщения на части не длиннее limit символов.
+    Режет по границам абзацев/строк/слов, незакрытые на месте разреза теги
+    закрывает в конце части и заново открывает в начале следующей
+
+    :param text: текст сообщения (parseMode=HTML)
+    :param limit: максимальная длина одной части
+    :return: список частей сообщения
+    """
+    return [part + closing for part, closing in _iter_parts(text, limit)]
+
+
+def truncate_message(text: str, limit: int = MAX_MESSAGE_LENGTH, ellipsis: str = '…') -> str:
+    """
+    Обрезает HTML-текст сообщения до limit символов, не ломая разметку
+
+    :param text: текст сообщения (parseMode=HTML)
+    :param limit: максимальная длина сообщения
+    :param ellipsis: чем пометить обрезанный текст
+    :return: обрезанный текст
+    """
+    if len(text) <= limit:
+        return text
+    part, closing = next(_iter_parts(text, limit - len(ellipsis)))
+    return part + ellipsis + closing
+
+
+class PartialSendError(Exception):
+    """
+    Сообщение, разбитое на части, отправлено не целиком: первая часть уже в чате, а очередная не ушла.
+    Исходная ошибка - в __cause__
+    """
+
+    def __init__(self, msg_id: str, remainder: dict):
+        """
+        :param msg_id: id первой части сообщения
+        :param remainder: параметры _send_message для досылки оставшихся частей
+        """
+        super().__init__(f'Message {msg_id} is sent partially, {remainder["first_part"]} parts delivered')
+        self.msg_id = msg_id
+        self.remainder = remainder
+
 
 class Bot:
     """
@@ -13,17 +190,51 @@ class Bot:
 
     base_url = 'https://api.internal.myteam.mail.ru/bot/v1/'
     last_event_id = 0
+    max_message_length = MAX_MESSAGE_LENGTH
 
-    def __init__(self, token: str, base_url: str = ''):
+    def __init__(self, token: str, base_url: str = '', timeout: float = 30,
+                 breaker: CircuitBreaker = None, outbox_size: int = 1000, rate_limit: float = 0):
         """
         :param token: VK Teams bot token, получать у @metabot
         :param base_url: url для bot api, получать у @metabot
+        :param timeout: таймаут http-запросов к bot api в секундах,
+                        чтобы зависшее соединение не подвесило бота
+        :param breaker: предохранитель для запросов к bot api
+        :param outbox_size: сколько исходящих сообщений копить, пока bot api недоступен
+        :param rate_limit: не больше стольких отправок/редактирований сообщений в секунду, 0 - без ограничения
         """
         self.token = token
+        self.timeout = timeout
         if base_url:
             self.base_url = base_url
+        self.breaker = breaker or CircuitBreaker('VK Teams')
+        # исходящие сообщения, которые не удалось отправить из-за недоступности bot api
+        self.outbox = deque(maxlen=outbox_size)
+        # outbox меняют одновременно потоки коллбэков, отправки уведомлений и flush_outbox
+        self._outbox_lock = threading.Lock()
+        self.rate_limit = rate_limit
+        self._next_post_at = 0.0
+        self._rate_lock = threading.Lock()
         self.nickname = self.get_self_nick()
 
+    def _request(self, http_method: str, method: str, **kwargs) -> requests.Response:
+        """
+        Выполняет запрос к bot api через предохранитель.
+        Отказом bot api считаются сетевые ошибки и ответы 5xx
+
+        :param http_method: 'GET' или 'POST'
+        :param method: метод bot api, например 'messages/sendText'
+        :param kwargs: параметры для requests.request
+        :return: ответ сервера
+        """
+        def do_request():
+            resp = requests.request(http_method, self.base_url + method, timeout=self.timeout, **kwargs)
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            return resp
+
+        return self.breaker.call(do_request)
+
     def get_self_nick(self):
         """
         Бот получает собственный никнейм и сохраняет его в соответствующем поле
@@ -31,36 +242,182 @@ class Bot:
         params = {
             "token": self.token,
         }
-        resp = requests.get(
-            url=self.base_url + "/self/get",
-            params=params
-        )
+        resp = self._request('GET', "self/get", params=params)
         return resp.json()['nick']
 
-    def send_message(self, text: str, chat_id: str, inline_kb: str = ''):
+    def _throttle(self):
+        """
+        Выдерживает паузу между сообщениями, чтобы не превышать rate_limit.
+        Каждый вызов бронирует себе очередной слот, поэтому ограничение соблюдается и из нескольких потоков
+        """
+        if not self.rate_limit:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_post_at)
+            self._next_post_at = slot + 1 / self.rate_limit
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _post(self, method: str, params: dict) -> dict:
+        """
+        Вызывает метод bot api POST-запросом: параметры передаются в теле запроса,
+        а не в url, поэтому длинные тексты не упираются в ограничения на длину url.
+        Запросы выполняются не чаще rate_limit в секунду
+
+        :param method: метод bot api, например 'messages/sendText'
+        :param params: параметры метода (без токена)
+        :return: ответ сервера
+        """
+        self._throttle()
+        resp = self._request('POST', method, data={"token": self.token, **params})
+        logger.info(f"Server answer: {resp.text}")
+        try:
+            return resp.json()
+        except requests.exceptions.JSONDecodeError:
+            logger.error(f'Error decoding json "{resp.text}"')
+            return {}
+
+    def _postpone(self, action: str, **kwargs):
+        """
+        Откладывает отправку/редактирование сообщения до восстановления bot api (см. flush_outbox).
+        Для редактирования одного и того же сообщения хранится только последняя версия.
+        Вместе с сообщением запоминается ключ трассы, чтобы задержка отправки попала в трассу письма
+
+        :param action: 'send_message' или 'edit_message'
+        :param kwargs: параметры соответствующего метода
+        """
+        with self._outbox_lock:
+            if action == 'edit_message':
+                for pending in list(self.outbox):
+                    if pending[0] == action and pending[1]['msg_id'] == kwargs['msg_id']:
+                        self.outbox.remove(pending)
+            if len(self.outbox) == self.outbox.maxlen:
+                logger.error('Outbox is full, dropping the oldest message')
+            self.outbox.append((action, kwargs, tracing.current_trace()))
+            queued = len(self.outbox)
+        logger.debug(f"VK Teams is unavailable, {action} postponed ({queued} in outbox)")
+
+    def _requeue(self, pending: tuple):
+        """
+        Возвращает неотправленное сообщение в начало outbox.
+        Редактирование не возвращается, если пока оно отправлялось, то же сообщение уже отредактировали заново
+        """
+        action, kwargs, _ = pending
+        with self._outbox_lock:
+            if action == 'edit_message' and any(
+                    other[0] == action and other[1]['msg_id'] == kwargs['msg_id'] for other in self.outbox
+            ):
+                return
+            self.outbox.appendleft(pending)
+
+    def flush_outbox(self) -> int:
+        """
+        Отправляет сообщения, отложенные пока bot api был недоступен
+
+        :return: количество отправленных сообщений
+        """
+        sent = 0
+        while not self.breaker.is_open:
+            with self._outbox_lock:
+                if not self.outbox:
+                    break
+                pending = self.outbox.popleft()
+            action, kwargs, trace_id = pending
+            try:
+                with tracing.trace(trace_id):
+                    getattr(self, '_' + action)(**kwargs, postpone=False)
+            except CircuitOpenError:
+                # bot api всё ещё недоступен - возвращаем в начало очереди и ждём следующего раза
+                self._requeue(pending)
+                break
+            except PartialSendError as e:
+                # отправленные части повторно не шлём - в очередь возвращаем только оставшиеся
+                self._requeue((action, e.remainder, trace_id))
+                if isinstance(e.__cause__, CircuitOpenError):
+                    break
+                raise
+            except Exception:
+                self._requeue(pending)
+                raise
+            sent += 1
+        if sent:
+            logger.info(f"Sent {sent} postponed messages, {len(self.outbox)} left")
+        return sent
+
+    def send_message(self, text: str, chat_id: str, inline_kb: str = '', postpone: bool = True) -> Union[str, None]:
         """
-        Отправляет сообщение в VK Teams
+        Отправляет сообщение в VK Teams.
+        Если текст не влезает в одно сообщение, то он разбивается на части (см. split_message),
+        клавиатура прикрепляется к первой части, а остальные части отправляются ответами на неё.
+        Если bot api недоступен, то сообщение откладывается до его восстановления (см. flush_outbox)
 
         :param text: текст сообщения
         :param chat_id: адресат
         :param inline_kb: клавиатура (см. api vk teams)
+        :param postpone: откладывать ли сообщение, если bot api недоступен.
+                         False - пробросить ошибку, например если у вызывающего своя очередь.
+                         Оставшиеся части уже начатого сообщения откладываются в любом случае
+        :return: id первого отправленного сообщения, None если сообщение отложено
         """
+        try:
+            return self._send_message(text, chat_id, inline_kb, postpone)
+        except PartialSendError as e:
+            # первая часть с клавиатурой уже в чате, оставшиеся досылаем вместе с отложенными сообщениями
+            logger.warning(f'{e}: {e.__cause__!r}, the rest is postponed')
+            self._postpone('send_message', **e.remainder)
+            return e.msg_id
 
-        logger.info(f"Sending message to: {chat_id}")
-        params = {
-            "token": self.token,
-            "chatId": chat_id,
-            "parseMode": "HTML",
-            "text": text
-        }
-        if inline_kb:
-            params.update(inlineKeyboardMarkup=inline_kb)
+    def _send_message(self, text: str, chat_id: str, inline_kb: str = '', postpone: bool = True,
+                      first_part: int = 0, reply_to: str = None) -> Union[str, None]:
+        """
+        :param first_part: с какой части начинать: предыдущие уже отправлены (см. PartialSendError)
+        :param reply_to: id первой части, если она уже отправлена
+        :raises PartialSendError: если первая часть отправлена, а одна из следующих - нет
+        """
+        with tracing.span('vkt.send', chat_id=chat_id, from_outbox=not postpone) as attrs:
+            if postpone and self.breaker.is_open:
+                self._postpone('send_message', text=text, chat_id=chat_id, inline_kb=inline_kb)
+                attrs['postponed'] = True
+                return None
 
-        resp = requests.get(
-            url=self.base_url + "messages/sendText",
-            params=params
-        )
-        logger.info(f"Server answer: {resp.text}")
+            parts = split_message(text, self.max_message_length)
+            attrs['parts'] = len(parts)
+            logger.info(f"Sending message to: {chat_id}" + (f" ({len(parts)} parts)" if len(parts) > 1 else ""))
+
+            first_msg_id = reply_to
+            for i, part in enumerate(parts):
+                if i < first_part:
+                    continue
+                params = {
+                    "chatId": chat_id,
+                    "parseMode": "HTML",
+                    "text": part
+                }
+                if i == 0 and inline_kb:
+                    params.update(inlineKeyboardMarkup=inline_kb)
+                if i > 0 and first_msg_id:
+                    # продолжение привязываем к первому сообщению
+                    params.update(replyMsgId=first_msg_id)
+
+                try:
+                    answer = self._post("messages/sendText", params)
+                except Exception as e:
+                    if i > 0:
+                        remainder = dict(text=text, chat_id=chat_id, inline_kb=inline_kb,
+                                         first_part=i, reply_to=first_msg_id)
+                        raise PartialSendError(first_msg_id, remainder) from e
+                    if not postpone:
+                        raise
+                    # сообщение целиком не ушло - откладываем его
+                    self._postpone('send_message', text=text, chat_id=chat_id, inline_kb=inline_kb)
+                    attrs['postponed'] = True
+                    if isinstance(e, CircuitOpenError):
+                        return None
+                    raise
+                if i == 0:
+                    first_msg_id = answer.get('msgId')
+            return first_msg_id
 
     def get_events(self, event_types: list[str] = None) -> list[dict]:
         """
@@ -81,10 +438,7 @@ class Bot:
             "pollTime": "2"
         }
 
-        resp = requests.get(
-            url=self.base_url + "/events/get",
-            params=params
-        )
+        resp = self._request('GET', "events/get", params=params)
         logger.debug(f"Server answer: {resp.text}")
 
         try:
@@ -102,6 +456,27 @@ class Bot:
 
         return list(filter(lambda e: e["type"] in event_types, events))
 
+    def answer_callback_query(self, query_id: str, text: str = '', show_alert: bool = False):
+        """
+        Отвечает на нажатие callback-кнопки, чтобы у пользователя перестал крутиться индикатор.
+        Ответ имеет смысл только сразу после нажатия, поэтому при недоступности bot api не откладывается
+
+        :param query_id: id нажатия (queryId из события callbackQuery)
+        :param text: текст всплывающего уведомления
+        :param show_alert: показать текст как alert, а не как уведомление
+        """
+        params = {
+            "token": self.token,
+            "queryId": query_id,
+        }
+        if text:
+            params.update(text=text, showAlert=str(show_alert).lower())
+
+        try:
+            self._request('GET', "messages/answerCallbackQuery", params=params)
+        except CircuitOpenError:
+            logger.debug(f"VK Teams is unavailable, callback query {query_id} is not answered")
+
     def edit_message(self, msg_id: str, text: str, chat_id: str, inline_kb: str = ''):
         """
         Редактирует сообщение в VK Teams
@@ -111,20 +486,30 @@ class Bot:
         :param chat_id: адресат
         :param inline_kb: клавиатура (см. bot api)
         """
+        self._edit_message(msg_id, text, chat_id, inline_kb)
 
-        logger.info(f"Editing message {msg_id} on {chat_id}")
-        params = {
-            "token": self.token,
-            "msgId": msg_id,
-            "chatId": chat_id,
-            "parseMode": "HTML",
-            "text": text
-        }
-        if inline_kb:
-            params.update(inlineKeyboardMarkup=inline_kb)
+    def _edit_message(self, msg_id: str, text: str, chat_id: str, inline_kb: str = '', postpone: bool = True):
+        with tracing.span('vkt.edit', chat_id=chat_id, from_outbox=not postpone) as attrs:
+            if postpone and self.breaker.is_open:
+                self._postpone('edit_message', msg_id=msg_id, text=text, chat_id=chat_id, inline_kb=inline_kb)
+                attrs['postponed'] = True
+                return
 
-        resp = requests.get(
-            url=self.base_url + "/messages/editText",
-            params=params
-        )
-        logger.info(f"Server answer: {resp.text}")
+            logger.info(f"Editing message {msg_id} on {chat_id}")
+            # отредактированное сообщение нельзя разбить на части, поэтому обрезаем
+            params = {
+                "msgId": msg_id,
+                "chatId": chat_id,
+                "parseMode": "HTML",
+                "text": truncate_message(text, self.max_message_length)
+            }
+            if inline_kb:
+                params.update(inlineKeyboardMarkup=inline_kb)
+
+            try:
+                self._post("messages/editText", params)
+            except CircuitOpenError:
+                if not postpone:
+                    raise
+                self._postpone('edit_message', msg_id=msg_id, text=text, chat_id=chat_id, inline_kb=inline_kb)
+                attrs['postponed'] = True
@@ -5,6 +5,8 @@ from typing import List
 
 import requests
 
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
 logger = logging.getLogger(__name__)
 
 
@@ -25,23 +27,31 @@ class VKTLoggerHandler(StreamHandler):
         self.token = token
         self.chats = chats
         self.timeout = timeout
+        # while VK Teams is down, drop log records at once instead of retrying each of them
+        self.breaker = CircuitBreaker('VK Teams logger', failure_threshold=3, recovery_timeout=60)
 
     def emit(self, record):
+        if self.breaker.is_open:
+            return
         msg = self.format(record)
         for chat_id in self.chats:
             t0 = time()
             while time() - t0 < self.timeout:
                 try:
-                    requests.get(
+                    self.breaker.call(
+                        requests.get,
                         url=self.base_url + "messages/sendText",
                         params={
                             "token": self.token,
                             "chatId": chat_id,
                             "parseMode": "HTML",
                             "text": msg
-                        }
+                        },
+                        timeout=self.timeout
                     )
                     break
+                except CircuitOpenError:
+                    return
                 except Exception as ex:
                     logger.exception("Exception while sending %s to %s:", msg, chat_id)
                     sleep(1)
\ No newline at end of file